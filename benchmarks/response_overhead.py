@@ -0,0 +1,53 @@
+"""Microbenchmark of the per-response overhead of the dispatcher
+
+Run from the repository root with: PYTHONPATH=. python benchmarks/response_overhead.py
+"""
+import timeit
+
+import lambdarest
+from lambdarest import create_lambda_handler, Response
+
+EVENT = {"httpMethod": "GET", "resource": "/", "body": None}
+BODY = {"id": 1, "name": "thing"}
+NUMBER = 20000
+
+
+class DictResponse(Response):
+    """Response with a per-instance __dict__, like before it got __slots__"""
+
+
+def bench(name, func):
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=5))
+    print("%-45s %8.2f us" % (name, seconds / NUMBER * 1e6))
+
+
+def build_handler(returns, after_request=False):
+    lambda_handler = create_lambda_handler()
+    lambda_handler.handle("get", load_json=False)(lambda event: returns())
+    if after_request:
+        lambda_handler.after_request(lambda response: response)
+    return lambda handler=lambda_handler: handler(dict(EVENT))
+
+
+if __name__ == "__main__":
+    tuple_to_json = getattr(lambdarest, "__tuple_to_json")
+
+    print("building the proxy dict for a (body, status) tuple:")
+    bench("DictResponse(...).to_json()", lambda: DictResponse(BODY, 200).to_json())
+    bench("Response(...).to_json()", lambda: Response(BODY, 200).to_json())
+    bench(
+        "fast path",
+        lambda: tuple_to_json(BODY, 200, lambdarest.json.JSONEncoder, False),
+    )
+
+    print("full dispatch:")
+    bench("(body, status) tuple", build_handler(lambda: (BODY, 200)))
+    bench(
+        "(body, status) tuple with after_request",
+        build_handler(lambda: (BODY, 200), after_request=True),
+    )
+    bench("Response object", build_handler(lambda: Response(BODY, 200)))
+    bench(
+        "proxy dict passthrough",
+        build_handler(lambda: {"body": BODY, "statusCode": 200}),
+    )
@@ -0,0 +1,52 @@
+"""Microbenchmark of schema compiled response serializers against json.dumps
+
+Run from the repository root with: PYTHONPATH=. python benchmarks/response_serializer.py
+"""
+import json
+import timeit
+
+import lambdarest
+
+ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "price": {"type": "number"},
+        "name": {"type": "string"},
+        "active": {"type": "boolean"},
+        "tags": {"type": "array", "items": {"type": "string"}},
+    },
+}
+ITEM = {"id": 1, "price": 9.5, "name": "thing", "active": True, "tags": ["a", "b"]}
+ITEMS = [ITEM] * 1000
+
+
+class CustomEncoder(json.JSONEncoder):
+    def default(self, o):
+        return str(o)
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-40s %10.2f us" % (name, seconds / number * 1e6))
+
+
+if __name__ == "__main__":
+    compile_serializer = getattr(lambdarest, "__compile_serializer")
+    serialize_item = compile_serializer(ITEM_SCHEMA, CustomEncoder)
+    serialize_items = compile_serializer(
+        {"type": "array", "items": ITEM_SCHEMA}, CustomEncoder
+    )
+
+    bench(
+        "json.dumps(item)",
+        lambda: json.dumps(ITEM, cls=CustomEncoder, sort_keys=True),
+        50000,
+    )
+    bench("compiled serializer(item)", lambda: serialize_item(ITEM), 50000)
+    bench(
+        "json.dumps(1000 items)",
+        lambda: json.dumps(ITEMS, cls=CustomEncoder, sort_keys=True),
+        100,
+    )
+    bench("compiled serializer(1000 items)", lambda: serialize_items(ITEMS), 100)
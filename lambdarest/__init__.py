@@ -1,19 +1,59 @@
 # -*- coding: utf-8 -*-
+import base64
 import json
 import logging
+import math
+import random
+import re
+import time
 from string import Template
-from jsonschema import validate, ValidationError, FormatChecker
+from jsonschema import ValidationError, FormatChecker
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 from werkzeug.routing import Map, Rule
-from werkzeug.http import HTTP_STATUS_CODES
-from werkzeug.exceptions import HTTPException, NotFound
+from werkzeug.datastructures import Headers, MIMEAccept, MultiDict
+from werkzeug.http import HTTP_STATUS_CODES, parse_accept_header, parse_cookie
+from werkzeug.exceptions import BadRequest, HTTPException, RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+from werkzeug.http import parse_options_header
 from distutils.util import strtobool
+from io import BytesIO, StringIO
+from tempfile import SpooledTemporaryFile
 
-from functools import wraps, reduce
+from collections import deque
+
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import wraps, reduce, lru_cache
+from threading import BoundedSemaphore, Lock, local
 from typing import TypeVar, Union, List, Callable
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    # available in lambda runtimes with SnapStart enabled
+    from snapshot_restore_py import register_before_snapshot, register_after_restore
+except ImportError:
+    register_before_snapshot = register_after_restore = None
+
 __validate_kwargs = {"format_checker": FormatChecker()}
-__required_keys = ["httpMethod"]
-__either_keys = ["path", "resource"]
+__response_keys = frozenset(
+    [
+        "body",
+        "statusCode",
+        "headers",
+        "multiValueHeaders",
+        "statusDescription",
+        "isBase64Encoded",
+    ]
+)
 
 
 class Response(object):
@@ -24,6 +64,15 @@ class Response(object):
     if no headers are specified, empty dict is returned
     """
 
+    __slots__ = (
+        "body",
+        "status_code",
+        "headers",
+        "multiValueHeaders",
+        "status_code_description",
+        "isBase64Encoded",
+    )
+
     def __init__(
         self,
         body=None,
@@ -39,25 +88,53 @@ class Response(object):
         self.status_code_description = None
         self.isBase64Encoded = isBase64Encoded
 
-    def to_json(self, encoder=json.JSONEncoder, application_load_balancer=False):
+    def to_json(
+        self,
+        encoder=json.JSONEncoder,
+        application_load_balancer=False,
+        serializer=None,
+        codec=None,
+    ):
         """Generates and returns an object with the expected field names.
 
+        `codec` is a (mimetype, dumps) tuple negotiated from the Accept header,
+        the body is then encoded with it and returned base64 encoded.
+
         Note: method name is slightly misleading, should be populate_response or with_defaults etc
         """
         status_code = self.status_code or 200
+        headers = self.headers
+        multiValueHeaders = self.multiValueHeaders
+        isBase64Encoded = self.isBase64Encoded
         # if it's already a str, we don't need json.dumps
         do_json_dumps = self.body is not None and not isinstance(self.body, str)
+        if do_json_dumps and codec is not None:
+            mimetype, dumps = codec
+            body = base64.b64encode(dumps(self.body)).decode("ascii")
+            isBase64Encoded = True
+            if multiValueHeaders == None:
+                headers = dict(headers or {}, **{"Content-Type": mimetype})
+            else:
+                multiValueHeaders = dict(
+                    multiValueHeaders, **{"Content-Type": [mimetype]}
+                )
+        elif do_json_dumps and serializer is None:
+            body = json.dumps(self.body, cls=encoder, sort_keys=True)
+        elif do_json_dumps:
+            body = serializer(self.body)
+        else:
+            body = self.body
         response = {
-            "body": json.dumps(self.body, cls=encoder, sort_keys=True)
-            if do_json_dumps
-            else self.body,
+            "body": body,
             "statusCode": status_code,
         }
         # handle multiValueHeaders if defined, default to headers
-        if self.multiValueHeaders == None:
-            response["headers"] = self.headers or {}
+        if multiValueHeaders == None:
+            response["headers"] = headers or {}
         else:
-            response["multiValueHeaders"] = self.multiValueHeaders
+            response["multiValueHeaders"] = multiValueHeaders
+        if isBase64Encoded and not application_load_balancer:
+            response["isBase64Encoded"] = True
         # if body is None, remove the key
         if response.get("body") == None:
             response.pop("body")
@@ -71,43 +148,620 @@ class Response(object):
                     #   https://docs.aws.amazon.com/elasticloadbalancing/latest/application/lambda-functions.html#respond-to-load-balancer
                     "statusDescription": self.status_code_description
                     or "HTTP " + HTTP_STATUS_CODES[status_code],
-                    "isBase64Encoded": self.isBase64Encoded,
+                    "isBase64Encoded": isBase64Encoded,
                 }
             )
         return response
 
 
+# lambda rejects synchronous responses above 6MB, leave room for headers
+MAX_RESPONSE_BYTES = 6 * 1024 * 1024 - 64 * 1024
+
+
+class StreamingResponse(Response):
+    """Response encoding an iterable of items incrementally, as a json array
+    (`format="json"`) or newline delimited json (`format="ndjson"`).
+
+    Items are consumed lazily so peak memory is bounded by the encoded output.
+    When the next item would make the body exceed `max_bytes` encoding stops
+    and a truncated 206 response is returned, with the number of items sent in
+    `Content-Range` and, if `next_page` is given, a `Link` header to
+    `next_page(items_sent)`.
+    """
+
+    __slots__ = ("format", "max_bytes", "next_page")
+
+    def __init__(
+        self,
+        items,
+        status_code=None,
+        headers=None,
+        format="json",
+        max_bytes=MAX_RESPONSE_BYTES,
+        next_page=None,
+    ):
+        if format not in ("json", "ndjson"):
+            raise ValueError("format must be 'json' or 'ndjson'")
+        super().__init__(items, status_code, headers)
+        self.format = format
+        self.max_bytes = max_bytes
+        self.next_page = next_page
+
+    def encode(self, encoder=json.JSONEncoder):
+        """Returns the encoded body and the number of items, None if complete"""
+        encode_item = encoder(sort_keys=True).encode
+        if self.format == "json":
+            opening, separator, closing = "[", ", ", "]"
+        else:
+            opening, separator, closing = "", "\n", "\n"
+
+        buffer = StringIO()
+        buffer.write(opening)
+        size = len(opening) + len(closing)
+        count = 0
+        for item in self.body:
+            chunk = encode_item(item)
+            if count:
+                chunk = separator + chunk
+            # ensure_ascii encoding, so characters are bytes
+            size += len(chunk)
+            if size > self.max_bytes:
+                buffer.write(closing)
+                return buffer.getvalue(), count
+            buffer.write(chunk)
+            count += 1
+        if count or self.format == "json":
+            buffer.write(closing)
+        return buffer.getvalue(), None
+
+    def to_json(self, encoder=json.JSONEncoder, application_load_balancer=False, **_):
+        body, truncated_count = self.encode(encoder)
+        headers = dict(self.headers or {})
+        headers.setdefault(
+            "Content-Type",
+            "application/json" if self.format == "json" else "application/x-ndjson",
+        )
+        status_code = self.status_code
+        if truncated_count is not None:
+            status_code = 206
+            headers["Content-Range"] = (
+                "items 0-%s/*" % (truncated_count - 1)
+                if truncated_count
+                else "items */*"
+            )
+            if self.next_page is not None:
+                headers["Link"] = '<%s>; rel="next"' % self.next_page(truncated_count)
+        return Response(body, status_code, headers).to_json(
+            application_load_balancer=application_load_balancer
+        )
+
+
+_MISSING = object()
+
+
+def _query_multi_dict(event):
+    """Query parameters of an event as a MultiDict, keeping repeated keys when
+    `multiValueQueryStringParameters` are sent"""
+    return MultiDict(
+        event.get("multiValueQueryStringParameters")
+        or event.get("queryStringParameters")
+        or {}
+    )
+
+
+def _request_line(event):
+    """Returns the http method and path of an event, read from the request
+    context of HTTP api (payload format 2.0) events"""
+    if event.get("version") == "2.0" and "httpMethod" not in event:
+        http = (event.get("requestContext") or {}).get("http") or {}
+        return http.get("method"), event.get("rawPath") or http.get("path")
+    return event.get("httpMethod"), event.get("path")
+
+
+class Request(object):
+    """Read-only view over a proxy event, passed to handlers registered with
+    `handle(..., request=True)` instead of the event itself.
+
+    Accessors are built lazily on first use and memoized, the event is never
+    copied or mutated:
+
+    headers: case insensitive `werkzeug.datastructures.Headers`
+    query: `werkzeug.datastructures.MultiDict` of the query string parameters
+    cookies: cookies from the `Cookie` header (or `cookies` of http api events)
+    body: the raw body string
+    data: the body as bytes, base64 encoded bodies are decoded once
+    body_view: a memoryview over `data`, slicing it does not copy
+    json: the parsed body and query params, like `event["json"]`
+    form/files: fields and uploaded files of form bodies, as `MultiDict`s
+
+    On routes with `load_json=False` json and form/files are parsed on first
+    access, by content type like other routes. Bodies which can not be
+    decoded raise `werkzeug.exceptions.BadRequest`, answered with 400.
+    """
+
+    __slots__ = (
+        "event",
+        "context",
+        "rule",
+        "path_params",
+        "_headers",
+        "_query",
+        "_cookies",
+        "_json",
+        "_data",
+        "_form",
+        "_files",
+        "_form_parser",
+    )
+
+    def __init__(self, event, context=None, rule=None, path_params=None):
+        self.event = event
+        self.context = context
+        self.rule = rule
+        self.path_params = path_params or {}
+        self._headers = self._query = self._cookies = self._json = _MISSING
+        self._data = _MISSING
+        self._form = self._files = self._form_parser = None
+
+    @property
+    def method(self):
+        return _request_line(self.event)[0]
+
+    @property
+    def path(self):
+        return _request_line(self.event)[1] or self.event.get("resource")
+
+    @property
+    def headers(self):
+        if self._headers is _MISSING:
+            self._headers = Headers(
+                self.event.get("multiValueHeaders") or self.event.get("headers") or {}
+            )
+        return self._headers
+
+    @property
+    def query(self):
+        if self._query is _MISSING:
+            self._query = _query_multi_dict(self.event)
+        return self._query
+
+    @property
+    def cookies(self):
+        if self._cookies is _MISSING:
+            if self.event.get("cookies"):
+                self._cookies = parse_cookie("; ".join(self.event["cookies"]))
+            else:
+                self._cookies = parse_cookie(self.headers.get("cookie", ""))
+        return self._cookies
+
+    @property
+    def body(self):
+        return self.event.get("body")
+
+    @property
+    def data(self):
+        if self._data is _MISSING:
+            body = self.body or ""
+            if self.event.get("isBase64Encoded"):
+                self._data = base64.b64decode(body)
+            else:
+                self._data = body.encode("utf-8")
+        return self._data
+
+    @property
+    def body_view(self):
+        return memoryview(self.data)
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._load_form()
+        return self._form
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._load_form()
+        return self._files
+
+    def _load_form(self):
+        form, files = _load_form(
+            self.data, self.headers.get("content-type"), self._form_parser
+        )
+        self._form = MultiDict() if form is None else form
+        self._files = MultiDict() if files is None else files
+
+    @property
+    def is_base64_encoded(self):
+        return bool(self.event.get("isBase64Encoded"))
+
+    @property
+    def json(self):
+        if self._json is _MISSING:
+            body = self.data if self.is_base64_encoded else self.body
+            json_body, form, files = _load_body(
+                body, self.headers.get("content-type"), self._form_parser
+            )
+            if form is not None:
+                self._form, self._files = form, files
+            self._json = {
+                "body": json_body,
+                "query": {
+                    key: values[0] if len(values) == 1 else values
+                    for key, values in self.query.lists()
+                },
+            }
+        return self._json
+
+
+def __copy_response(response):
+    """Returns a `Response` with headers of its own, so after request handlers
+    changing them do not change `response`"""
+    return Response(
+        response.body,
+        response.status_code,
+        dict(response.headers) if response.headers else None,
+        dict(response.multiValueHeaders) if response.multiValueHeaders else None,
+        response.isBase64Encoded,
+    )
+
+
+def __to_response(response):
+    """Wraps the return value of a handler in a `Response`"""
+    if isinstance(response, Response):
+        return response
+
+    # Set defaults
+    status_code = headers = multiValueHeaders = None
+    isBase64Encoded = False
+
+    if isinstance(response, tuple):
+        response_len = len(response)
+        if response_len > 3:
+            raise ValueError("Response tuple has more than 3 items")
+
+        # Unpack the tuple, missing items will be defaulted
+        body, status_code, headers, multiValueHeaders = response + (None,) * (
+            4 - response_len
+        )
+
+    elif isinstance(response, dict) and response.keys() <= __response_keys:
+        body = response.get("body")
+        status_code = response.get("statusCode") or status_code
+        headers = response.get("headers") or headers
+        multiValueHeaders = response.get("multiValueHeaders") or multiValueHeaders
+        isBase64Encoded = response.get("isBase64Encoded") or isBase64Encoded
+
+    else:  # if response is string, int, etc.
+        body = response
+    return Response(body, status_code, headers, multiValueHeaders, isBase64Encoded)
+
+
+def __tuple_to_json(
+    body, status_code, encoder, application_load_balancer, serializer=None
+):
+    """Same as `Response(body, status_code).to_json(...)` without the Response"""
+    status_code = status_code or 200
+    if body is None:
+        response = {"statusCode": status_code, "headers": {}}
+    else:
+        if isinstance(body, str):
+            pass
+        elif serializer is None:
+            body = json.dumps(body, cls=encoder, sort_keys=True)
+        else:
+            body = serializer(body)
+        response = {"body": body, "statusCode": status_code, "headers": {}}
+    if application_load_balancer:
+        response["statusDescription"] = "HTTP " + HTTP_STATUS_CODES[status_code]
+        response["isBase64Encoded"] = False
+    return response
+
+
+def __compile_serializer(schema, encoder=json.JSONEncoder):
+    """Compiles a json schema into a function encoding conforming values.
+
+    The output is identical to `json.dumps(value, cls=encoder, sort_keys=True)`
+    but object fields are emitted in precomputed order and scalars by type.
+    Large arrays and values not matching the schema go through a single
+    reused encoder instance, whose C implementation wins on bulk data.
+    """
+    generic = encoder(sort_keys=True).encode
+
+    if not isinstance(schema, dict):
+        return generic
+
+    schema_type = schema.get("type")
+    if schema_type == "string":
+
+        def encode_string(value):
+            if type(value) is str:
+                return json.encoder.encode_basestring_ascii(value)
+            return generic(value)
+
+        return encode_string
+
+    if schema_type in ("integer", "number"):
+
+        def encode_number(value):
+            if type(value) is int:
+                return int.__repr__(value)
+            if type(value) is float and math.isfinite(value):
+                return float.__repr__(value)
+            return generic(value)
+
+        return encode_number
+
+    if schema_type == "boolean":
+
+        def encode_boolean(value):
+            if value is True:
+                return "true"
+            if value is False:
+                return "false"
+            return generic(value)
+
+        return encode_boolean
+
+    if schema_type == "array" and isinstance(schema.get("items"), dict):
+        encode_item = __compile_serializer(schema["items"], encoder)
+
+        def encode_array(value):
+            # the C encoder wins once its setup cost is spread over many items
+            if type(value) is not list or len(value) > 32:
+                return generic(value)
+            return "[" + ", ".join([encode_item(item) for item in value]) + "]"
+
+        return encode_array
+
+    if schema_type == "object" and isinstance(schema.get("properties"), dict):
+        properties = schema["properties"]
+        known_keys = frozenset(properties)
+        fields = [
+            (key, json.encoder.encode_basestring_ascii(key) + ": ")
+            for key in sorted(properties)
+        ]
+        encoders = {
+            key: __compile_serializer(properties[key], encoder) for key in properties
+        }
+
+        def encode_object(value):
+            if type(value) is not dict or not value.keys() <= known_keys:
+                return generic(value)
+            return (
+                "{"
+                + ", ".join(
+                    [
+                        prefix + encoders[key](value[key])
+                        for key, prefix in fields
+                        if key in value
+                    ]
+                )
+                + "}"
+            )
+
+        return encode_object
+
+    return generic
+
+
+def __compile_structural_check(schema):
+    """Compiles the `type: object` and `required` keywords of a schema (following
+    `properties`) into a cheap check raising the same ValidationError as
+    jsonschema would for a missing key or a non object value"""
+    checks = []
+
+    def collect(node, path, schema_path):
+        if not isinstance(node, dict):
+            return
+        required = tuple(node.get("required") or ())
+        is_object = node.get("type") == "object"
+        if required or is_object:
+            checks.append((path, schema_path, required, is_object))
+        for key, child in (node.get("properties") or {}).items():
+            collect(child, path + (key,), schema_path + ("properties", key))
+
+    collect(schema, (), ())
+
+    def error(message, validator, path, schema_path):
+        return ValidationError(
+            message,
+            validator=validator,
+            path=deque(path),
+            schema_path=deque(schema_path + (validator,)),
+        )
+
+    def check(instance):
+        for path, schema_path, required, is_object in checks:
+            value = instance
+            try:
+                for key in path:
+                    value = value[key]
+            except (KeyError, TypeError, IndexError):
+                # optional parts which are not present are not checked
+                continue
+            if not isinstance(value, dict):
+                if is_object or required:
+                    raise error(
+                        "%r is not of type 'object'" % (value,),
+                        "type",
+                        path,
+                        schema_path,
+                    )
+                continue
+            for key in required:
+                if key not in value:
+                    raise error(
+                        "%r is a required property" % key, "required", path, schema_path
+                    )
+
+    return check
+
+
+# mimetype -> (dumps, loads) of the binary encodings offered besides json
+__codecs = {}
+
+
+def register_codec(mimetype, dumps, loads):
+    """Offers `mimetype` in content negotiation, encoding response bodies with
+    `dumps` (returning bytes) and decoding request bodies with `loads`"""
+    __codecs[mimetype] = (dumps, loads)
+    __negotiate.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def __negotiate(accept):
+    """Returns the codec mimetype preferred by an Accept header, None for json"""
+    offers = ["application/json"] + list(__codecs)
+    mimetype = parse_accept_header(accept, MIMEAccept).best_match(offers)
+    return mimetype if mimetype in __codecs else None
+
+
+def __negotiate_codec(event):
+    if not __codecs:
+        return None
+    accept = __get_header(event, "accept")
+    if not accept:
+        return None
+    mimetype = __negotiate(accept)
+    if mimetype is None:
+        return None
+    return mimetype, __codecs[mimetype][0]
+
+
+if msgpack is not None:
+    register_codec(
+        "application/msgpack",
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+    register_codec(
+        "application/x-msgpack",
+        lambda value: msgpack.packb(value, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, raw=False),
+    )
+
+if cbor2 is not None:
+    register_codec("application/cbor", cbor2.dumps, cbor2.loads)
+
+
 # Response headers
 ACL_ORIGIN = "Access-Control-Allow-Origin"
 ACL_METHODS = "Access-Control-Allow-Methods"
 ACL_CREDENTIALS = "Access-Control-Allow-Credentials"
 ACL_MAX_AGE = "Access-Control-Max-Age"
+ACL_HEADERS = "Access-Control-Allow-Headers"
 
 ALL_METHODS = ["GET", "HEAD", "POST", "OPTIONS", "PUT", "PATCH", "DELETE"]
 
 
+def __get_header(event, name):
+    """Case insensitive lookup of a request header, `name` must be lowercase
+
+    Load balancers with multi value headers enabled only send
+    `multiValueHeaders`, the first value is returned then.
+    """
+    for key, value in (event.get("headers") or {}).items():
+        if key.lower() == name:
+            return value
+    for key, values in (event.get("multiValueHeaders") or {}).items():
+        if key.lower() == name and values:
+            return values[0]
+    return None
+
+
+def __compile_origin_matcher(origin):
+    """Returns None for a static origin, else a predicate for request origins
+
+    `origin` can be a string, an iterable of allowed origins or a compiled regex
+    """
+    if isinstance(origin, str):
+        return None
+    if hasattr(origin, "fullmatch"):
+        return lambda request_origin: origin.fullmatch(request_origin) is not None
+    return frozenset(origin).__contains__
+
+
 def CORS(
     lambda_handler,
     origin="*",
     methods=ALL_METHODS,
     supports_credentials=False,
     max_age=None,
+    allow_headers=None,
 ):
+    """Adds CORS headers to responses and answers preflight requests
+
+    The header block is computed once here. `OPTIONS` requests for routes
+    without an OPTIONS handler are answered before routing and body parsing,
+    advertising the methods the url map has registered for the path.
+    `origin` can also be a list of allowed origins or a compiled regex, in
+    which case the request origin is echoed back when it matches and every
+    response (including preflights) varies on `Origin`.
+    """
+    match_origin = __compile_origin_matcher(origin)
+
+    cors_headers = {ACL_METHODS: ", ".join(methods)}
+    if match_origin is None:
+        cors_headers[ACL_ORIGIN] = origin
+    else:
+        cors_headers["Vary"] = "Origin"
+    if supports_credentials:
+        cors_headers[ACL_CREDENTIALS] = supports_credentials
+    if max_age:
+        cors_headers[ACL_MAX_AGE] = max_age
+    if allow_headers:
+        cors_headers[ACL_HEADERS] = ", ".join(allow_headers)
+
+    # preflight header blocks keyed on the methods registered for a path
+    preflight_cache = {}
+    # responses to other origins differ too, caches must not share them
+    vary_headers = {"Vary": "Origin"}
+
+    def origin_headers(event):
+        if match_origin is None:
+            return cors_headers
+        request_origin = __get_header(event or {}, "origin")
+        if not request_origin or not match_origin(request_origin):
+            return vary_headers
+        headers = dict(cors_headers)
+        headers[ACL_ORIGIN] = request_origin
+        return headers
+
     def cors_after_request(response: Response) -> Response:
         headers = response.headers
         if headers is None:
             headers = dict()
 
-        headers.update({ACL_ORIGIN: origin, ACL_METHODS: ", ".join(methods)})
-        if supports_credentials:
-            headers.update({ACL_CREDENTIALS: supports_credentials})
-        if max_age:
-            headers.update({ACL_MAX_AGE: max_age})
+        headers.update(origin_headers(lambda_handler.current_event()))
 
         response.headers = headers
         return response
 
+    def cors_preflight(event, allowed_methods) -> Response:
+        block = origin_headers(event)
+        if ACL_ORIGIN not in block:
+            return Response(None, 204, dict(block))
+
+        methods_key = frozenset(allowed_methods)
+        route_methods = preflight_cache.get(methods_key)
+        if route_methods is None:
+            route_methods = preflight_cache[methods_key] = ", ".join(
+                method
+                for method in methods
+                if method.upper() in methods_key or method.upper() == "OPTIONS"
+            )
+
+        headers = dict(block)
+        headers[ACL_METHODS] = route_methods
+        if not allow_headers:
+            requested_headers = __get_header(event, "access-control-request-headers")
+            if requested_headers:
+                headers[ACL_HEADERS] = requested_headers
+        return Response(None, 204, headers)
+
     lambda_handler.after_request(cors_after_request)
+    lambda_handler.preflight(cors_preflight)
     return lambda_handler
 
 
@@ -120,6 +774,11 @@ Maybe = Union[None, T]
 BeforeRequestCallable = Callable[[], Maybe[Response]]
 
 
+# Called for OPTIONS requests to paths without an OPTIONS handler, before
+# routing, with the event and the methods registered for the path.
+PreflightCallable = Callable[[dict, List[str]], Response]
+
+
 # The function is called with the response object, and must return a response
 # object. This allows the functions to modify or replace the response before it
 # is sent.
@@ -130,6 +789,86 @@ class ScopeMissing(Exception):
     pass
 
 
+@lru_cache(maxsize=1024)
+def __parse_scopes(raw_scopes):
+    """Parses the json encoded scopes of an authorizer, memoized on the raw string"""
+    try:
+        scopes = json.loads(raw_scopes)
+    except (TypeError, json.decoder.JSONDecodeError):
+        # Ignore passed scopes if it isn't properly json encoded
+        return frozenset()
+    if isinstance(scopes, str):
+        return frozenset([scopes])
+    try:
+        return frozenset(scopes)
+    except TypeError:
+        return frozenset()
+
+
+def __provided_scopes(event):
+    try:
+        raw_scopes = event["requestContext"]["authorizer"]["scopes"]
+    except (KeyError, TypeError):
+        return frozenset()
+    if isinstance(raw_scopes, list):
+        return frozenset(raw_scopes)
+    return __parse_scopes(raw_scopes)
+
+
+def __scope_candidates(scope, separator="."):
+    """Returns the scope with the wildcards granting it, eg. for `a.b.c`:
+    `a.b.c`, `a.b.*`, `a.*` and `*`"""
+    parts = scope.split(separator)
+    wildcards = (
+        separator.join(parts[:i] + ["*"]) for i in range(len(parts) - 1, -1, -1)
+    )
+    return frozenset([scope, *wildcards])
+
+
+def __compile_scopes(scopes, mode="all", wildcards=False, separator="."):
+    """Compiles required scopes into a function returning the first missing
+    scope (None if the provided scopes are sufficient)
+
+    mode "all" requires every scope, "any" requires at least one of them.
+    With `wildcards` a provided scope ending in `*` grants the scopes below
+    it, their parts being split on `separator`.
+    """
+    if mode not in ("all", "any"):
+        raise ValueError("scopes_mode must be 'all' or 'any'")
+    if wildcards and not separator:
+        raise ValueError("scopes_separator can not be empty")
+
+    required = frozenset(scopes)
+    candidates = tuple(
+        (
+            scope,
+            __scope_candidates(scope, separator) if wildcards else frozenset([scope]),
+        )
+        for scope in scopes
+    )
+
+    def granted(provided, scope_candidates):
+        return not scope_candidates.isdisjoint(provided)
+
+    def missing_all(provided):
+        if required <= provided:
+            return None
+        for scope, scope_candidates in candidates:
+            if not granted(provided, scope_candidates):
+                return scope
+        return None
+
+    def missing_any(provided):
+        if not required.isdisjoint(provided):
+            return None
+        for scope, scope_candidates in candidates:
+            if granted(provided, scope_candidates):
+                return None
+        return candidates[0][0]
+
+    return missing_all if mode == "all" else missing_any
+
+
 def __cast_list(value, type):
     values_list = value.split(",")
 
@@ -182,7 +921,25 @@ def __marshall_value(value, query_param_schema_fragment):
     return value
 
 
+def __json_load_multi_dict(multi_dict, param_schema=None):
+    """Casts the values of a MultiDict with the schema, repeated keys become
+    lists whose items are cast with the `items` schema"""
+    param_schema = param_schema or {}
+    loaded = {}
+    for key, values in multi_dict.lists():
+        fragment = param_schema.get(key, {})
+        if len(values) == 1:
+            loaded[key] = __marshall_value(values[0], fragment)
+        else:
+            item_fragment = fragment.get("items", {})
+            loaded[key] = [__marshall_value(value, item_fragment) for value in values]
+    return loaded
+
+
 def __json_load_query(query, query_param_schema=None):
+    if isinstance(query, MultiDict):
+        return __json_load_multi_dict(query, query_param_schema)
+
     query = query or {}
     query_param_schema = query_param_schema or {}
 
@@ -192,34 +949,123 @@ def __json_load_query(query, query_param_schema=None):
     }
 
 
+FORM_MIMETYPES = frozenset(["application/x-www-form-urlencoded", "multipart/form-data"])
+
+
+class _CappedSpooledFile(SpooledTemporaryFile):
+    """Spooled file for uploaded parts refusing to grow beyond `max_bytes`"""
+
+    def __init__(self, max_bytes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._max_bytes = max_bytes
+        self._written = 0
+
+    def write(self, s):
+        self._written += len(s)
+        if self._written > self._max_bytes:
+            raise RequestEntityTooLarge()
+        return super().write(s)
+
+
+def __form_parser(max_part_bytes=None, spool_threshold=512 * 1024, max_bytes=None):
+    """Creates a werkzeug form parser spooling parts to temporary files above
+    `spool_threshold` and rejecting parts above `max_part_bytes` with 413"""
+
+    def stream_factory(
+        total_content_length, content_type, filename, content_length=None
+    ):
+        if max_part_bytes is None:
+            return SpooledTemporaryFile(max_size=spool_threshold, mode="rb+")
+        return _CappedSpooledFile(max_part_bytes, max_size=spool_threshold, mode="rb+")
+
+    return FormDataParser(
+        stream_factory=stream_factory,
+        max_form_memory_size=max_part_bytes,
+        max_content_length=max_bytes,
+        silent=False,
+    )
+
+
+def __parse_form(parser, body, content_type):
+    """Parses a form-urlencoded or multipart body into (form, files) MultiDicts"""
+    mimetype, options = parse_options_header(content_type)
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    body = body or b""
+    _, form, files = parser.parse(BytesIO(body), mimetype, len(body), options)
+    return form, files
+
+
+def _load_form(body, content_type, form_parser=None):
+    """Returns the (form, files) MultiDicts of form bodies, (None, None) for
+    bodies of other content types"""
+    mimetype = (content_type or "").split(";", 1)[0].strip().lower()
+    if mimetype not in FORM_MIMETYPES:
+        return None, None
+    try:
+        return __parse_form(form_parser or __form_parser(), body, content_type)
+    except ValueError:
+        raise BadRequest("Invalid form body")
+
+
+def _load_body(body, content_type, form_parser=None, body_param_schema=None):
+    """Parses a request body by its content type into (json_body, form, files)
+
+    Raises `BadRequest` for bodies which can not be decoded.
+    """
+    form, files = _load_form(body, content_type, form_parser)
+    if form is not None:
+        return __json_load_multi_dict(form, body_param_schema), form, files
+
+    mimetype = (content_type or "").split(";", 1)[0].strip().lower()
+    if mimetype in __codecs:
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        try:
+            return (__codecs[mimetype][1](body) if body else {}), None, None
+        except Exception:
+            raise BadRequest("Invalid %s body" % mimetype)
+    try:
+        return json.loads(body or "{}"), None, None
+    except ValueError:
+        # invalid json or encoding
+        raise BadRequest("Invalid json body")
+
+
+def __body_size(event):
+    """Size of the request body in bytes, estimated from the raw string"""
+    body = event.get("body")
+    if not body:
+        return 0
+    if event.get("isBase64Encoded"):
+        return len(body) * 3 // 4
+    return len(body)
+
+
+def __decode_body(event):
+    """Returns the body as sent: bytes for base64 encoded bodies, else str"""
+    body = event.get("body")
+    if body and event.get("isBase64Encoded"):
+        return base64.b64decode(body)
+    return body
+
+
 def default_error_handler(error, method):
     logging_message = "[%s][{status_code}]: {message}" % method
     logging.exception(logging_message.format(status_code=500, message=str(error)))
 
 
-def check_update_and_fill_resource_placeholders(resource, path_parameters):
-    """
-    Prepare resource parameters before routing.
-    In case when resource defined as /path/to/{placeholder}/resource,
-    the router can't find a correct handler.
-    This method inserts path parameters
-    instead of placeholders and returns the result.
+__placeholder_pattern = re.compile(r"\{([^{}]*)\}")
 
-    :param resource: Resource path definition
-    :param path_parameters: Path parameters dict
-    :return: resource definition with inserted path parameters
-    """
+
+def __fill_with_template(resource, path_parameters):
     base_resource = resource
 
     # prepare resource.
     # evaluate from /foo/{key1}/bar/{key2}/{proxy+}
     # to /foo/${key1}/bar/${key2}/{proxy+}
-
-    if path_parameters is not None:
-        for path_key in path_parameters:
-            resource = resource.replace("{%s}" % path_key, "${%s}" % path_key)
-    else:
-        return base_resource
+    for path_key in path_parameters:
+        resource = resource.replace("{%s}" % path_key, "${%s}" % path_key)
 
     # insert path_parameteres by template
     # /foo/${key1}/bar/${key2}/{proxy+} -> /foo/value1/bar/value2/{proxy+}
@@ -231,6 +1077,113 @@ def check_update_and_fill_resource_placeholders(resource, path_parameters):
         return base_resource
 
 
+@lru_cache(maxsize=1024)
+def __compile_resource(resource):
+    """Returns a function filling the {placeholders} of a resource definition
+
+    /foo/{key1}/bar/{key2}/{proxy+} is split once into its literal parts and
+    placeholder names, placeholders missing from the path parameters (like
+    {proxy+}) are kept as they are.
+    """
+    if "$" in resource:
+        # keep the string.Template semantics for resources using $
+        return lambda path_parameters: __fill_with_template(resource, path_parameters)
+
+    parts = __placeholder_pattern.split(resource)
+    if len(parts) == 1:
+        return lambda path_parameters: resource
+
+    # parts alternate between literals and placeholder names
+    literals = parts[0::2]
+    names = parts[1::2]
+    placeholders = tuple("{%s}" % name for name in names)
+
+    def fill(path_parameters):
+        filled = [literals[0]]
+        for name, placeholder, literal in zip(names, placeholders, literals[1:]):
+            value = path_parameters.get(name, _MISSING)
+            filled.append(placeholder if value is _MISSING else str(value))
+            filled.append(literal)
+        return "".join(filled)
+
+    return fill
+
+
+def check_update_and_fill_resource_placeholders(resource, path_parameters):
+    """
+    Prepare resource parameters before routing.
+    In case when resource defined as /path/to/{placeholder}/resource,
+    the router can't find a correct handler.
+    This method inserts path parameters
+    instead of placeholders and returns the result.
+
+    :param resource: Resource path definition
+    :param path_parameters: Path parameters dict
+    :return: resource definition with inserted path parameters
+    """
+    if path_parameters is None:
+        return resource
+    return __compile_resource(resource)(path_parameters)
+
+
+# Event sources supporting partial batch responses (batchItemFailures)
+SQS = "aws:sqs"
+KINESIS = "aws:kinesis"
+DYNAMODB = "aws:dynamodb"
+
+
+def __record_identifier(record):
+    """Returns the identifier lambda expects in `batchItemFailures` for a record"""
+    event_source = record.get("eventSource")
+    if event_source == KINESIS:
+        return record.get("kinesis", {}).get("sequenceNumber")
+    if event_source == DYNAMODB:
+        return record.get("dynamodb", {}).get("SequenceNumber")
+    return record.get("messageId")
+
+
+def __record_group(record):
+    """Returns the key of the records whose order has to be kept, None for
+    records of unordered sources (standard SQS queues)"""
+    event_source = record.get("eventSource")
+    if event_source == KINESIS:
+        return (KINESIS, record.get("kinesis", {}).get("partitionKey"))
+    if event_source == DYNAMODB:
+        # stream records are ordered per item
+        keys = record.get("dynamodb", {}).get("Keys")
+        return (DYNAMODB, json.dumps(keys, sort_keys=True))
+    group_id = (record.get("attributes") or {}).get("MessageGroupId")
+    if group_id is not None:
+        # FIFO queues
+        return (SQS, group_id)
+    return None
+
+
+def __record_attribute(record, name):
+    """Looks up `name` on the record itself, falling back to SQS message attributes"""
+    if name in record:
+        return record[name]
+    attribute = (record.get("messageAttributes") or {}).get(name) or {}
+    return attribute.get("stringValue")
+
+
+def __is_warmup_event(event):
+    """Scheduled CloudWatch events and custom `{"warmer": true}` keep-alive pings"""
+    return bool(event.get("warmer")) or (
+        event.get("source") == "aws.events"
+        and event.get("detail-type") == "Scheduled Event"
+    )
+
+
+def __deadline(context, margin=0.1):
+    """Returns the monotonic time at which the invocation runs out of time, if known"""
+    try:
+        remaining_ms = context.get_remaining_time_in_millis()
+    except AttributeError:
+        return None
+    return time.monotonic() + remaining_ms / 1000.0 - margin
+
+
 def __pipe_funcs(*funcs: Callable[[T], T]):
     def pipe(value):
         return reduce(lambda r, f: f(r), funcs, value)
@@ -238,10 +1191,203 @@ def __pipe_funcs(*funcs: Callable[[T], T]):
     return pipe
 
 
+def _check_route_options(
+    schema=None,
+    load_json=True,
+    scopes_mode="all",
+    scopes_wildcards=False,
+    scopes_separator=".",
+    validation=None,
+    rate_limit=None,
+    **options,
+):
+    """Raises ValueError for invalid `handle` options, so they fail when
+    routes are registered rather than on their first request"""
+    if schema and not load_json:
+        raise ValueError("if schema is supplied, load_json needs to be true")
+    if scopes_mode not in ("all", "any"):
+        raise ValueError("scopes_mode must be 'all' or 'any'")
+    if scopes_wildcards and not scopes_separator:
+        raise ValueError("scopes_separator can not be empty")
+    if validation not in (None, "always", "sampled", "structural"):
+        raise ValueError("validation must be 'always', 'sampled' or 'structural'")
+    if rate_limit is not None and rate_limit <= 0:
+        raise ValueError("rate_limit must be positive")
+
+
+class Blueprint(object):
+    """Group of routes with their own before/after request handlers, mounted
+    on a lambda handler under a path prefix with `lambda_handler.mount`
+
+    example:
+        users = Blueprint("users")
+
+        @users.handle("get", path="/<int:user_id>")
+        def get_user(event, user_id):
+            pass
+
+        lambda_handler.mount(users, "/users")
+
+    `handle` takes the same arguments as `lambda_handler.handle`, options
+    are checked right away but the routes are only compiled on the first
+    request for the prefix (again after routes are added). A `*` route
+    catches every path below the prefix.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.routes = []
+        self.before_request_handlers: List[BeforeRequestCallable] = []
+        self.after_request_handlers: List[AfterRequestCallable] = []
+        # called when routes are added, to recompile the mounted copies
+        self.listeners = []
+
+    def handle(self, method_name, path="/", **options):
+        if path != "*" and not path.startswith("/"):
+            raise ValueError("Please configure path with starting slash")
+        _check_route_options(**options)
+
+        def wrapper(func):
+            self.routes.append((method_name, path, options, func))
+            for listener in self.listeners:
+                listener()
+            return func
+
+        return wrapper
+
+    def before_request(self, func):
+        self.before_request_handlers.append(func)
+        return func
+
+    def after_request(self, func):
+        self.after_request_handlers.append(func)
+        return func
+
+
+class TokenBucket(object):
+    """Thread safe token bucket refilled with `rate` tokens per second, holding
+    at most `capacity` tokens (defaults to `rate`, at least 1)"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = max(1, rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def consume(self, tokens=1):
+        """Takes `tokens` from the bucket, returns False if there are not enough"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def retry_after(self, tokens=1):
+        """Returns the seconds until `tokens` tokens are available"""
+        if self.rate <= 0:
+            return math.inf
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+
+class AccessLog(object):
+    """Structured access log writing one json line per request
+
+    Entries are sampled on their status code: `sample_rates` maps status
+    codes (eg. 404) or classes (eg. "4xx") to the fraction of the requests
+    to log, anything else is logged at `default_rate`. Sampled entries are
+    kept as tuples and only formatted when the buffer is flushed, at the end
+    of every invocation or when `buffer_size` entries are buffered, and only
+    if the logger is enabled for INFO.
+    """
+
+    fields = ("method", "path", "route", "status", "latency_ms", "request_id")
+
+    def __init__(
+        self, sample_rates=None, default_rate=1.0, logger=None, buffer_size=64
+    ):
+        self.sample_rates = dict(sample_rates or {})
+        self.default_rate = default_rate
+        self.logger = logger or logging.getLogger("lambdarest.access")
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = Lock()
+        self._rates = {}
+
+    def rate_for(self, status):
+        try:
+            return self._rates[status]
+        except KeyError:
+            pass
+        rate = self.sample_rates.get(status)
+        if rate is None:
+            rate = self.sample_rates.get("%sxx" % (status // 100), self.default_rate)
+        self._rates[status] = rate
+        return rate
+
+    def record(self, event, context, route, status, latency_ms):
+        rate = self.rate_for(status or 0)
+        if rate < 1 and random.random() >= rate:
+            return
+        request_id = getattr(context, "aws_request_id", None)
+        if request_id is None:
+            request_id = (event.get("requestContext") or {}).get("requestId")
+        method, path = _request_line(event)
+        entry = (
+            method,
+            path or event.get("resource"),
+            route,
+            status,
+            round(latency_ms, 3),
+            request_id,
+        )
+        with self.lock:
+            self.buffer.append(entry)
+            full = len(self.buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries, self.buffer = self.buffer, []
+        if not entries or not self.logger.isEnabledFor(logging.INFO):
+            return
+        for entry in entries:
+            self.logger.info(json.dumps(dict(zip(self.fields, entry))))
+
+
+def __prefix_path(prefix, path):
+    if path == "*":
+        return prefix + "/*"
+    if path == "/":
+        return prefix
+    return prefix + path
+
+
 def create_lambda_handler(
     error_handler=default_error_handler,
     json_encoder=json.JSONEncoder,
     application_load_balancer=False,
+    max_workers=8,
+    prime_on_warmup=True,
+    response_validation_rate=0.01,
+    validation="always",
+    validation_sample_rate=0.1,
+    max_body_bytes=None,
+    max_part_bytes=None,
+    spool_threshold=512 * 1024,
+    route_cache_size=1024,
+    base_path=None,
+    error_log_rate=10,
+    access_log=None,
+    unmatched_records="fail",
 ):
     """Create a lambda handler function with `handle` decorator as attribute
 
@@ -263,31 +1409,632 @@ def create_lambda_handler(
     The inner_handler is also able to validate incoming data using a specified
     JSON schema, please see http://json-schema.org for info.
 
+    Submit/map:
+    Run independent blocking calls of a request in parallel on the same pool.
+    Futures belong to the request being handled, anything still unfinished
+    when the response is returned is cancelled, and waiting respects the
+    invocation deadline given by the lambda context. Calls made from a thread
+    of the pool itself (eg. by record handlers or by tasks) run inline, as
+    waiting for the pool from within could deadlock it.
+
+    Validation:
+    Request schemas are compiled once. `validation` selects how they are
+    applied, globally or per handler: "always" validates every request,
+    "sampled" validates a `validation_sample_rate` fraction of the requests
+    and "structural" only checks required keys and object types. Failures
+    are always answered with 400.
+
+    Body size limits:
+    Bodies larger than `max_body_bytes` (globally or per handler) are
+    rejected with 413 based on the raw string length, before decoding.
+
+    Form bodies:
+    `application/x-www-form-urlencoded` and `multipart/form-data` bodies are
+    parsed with werkzeug and validated like json bodies. Uploaded files are
+    spooled to temporary files above `spool_threshold` bytes and parts larger
+    than `max_part_bytes` are rejected with 413.
+
+    Response schemas:
+    Handlers registered with a `response_schema` get a serializer compiled
+    from it, and a `response_validation_rate` fraction of their responses is
+    validated against it. Violations are logged and counted in
+    `lambda_handler.metrics["response_validation"]`, they never fail requests.
+
+    Warmup:
+    Keep-alive pings (scheduled CloudWatch events or `{"warmer": true}`) are
+    acknowledged before any proxy validation. Unless `prime_on_warmup` is
+    False the first one also compiles the routes and runs the functions
+    registered with `prime`, so caches and pools are filled before the next
+    real request. This happens once per container (and again after a restore
+    from a snapshot), pass `prime_on_warmup="always"` to prime on every ping.
+
+    Snapshot/restore:
+    Functions registered with `before_snapshot` run before the runtime takes a
+    snapshot of the initialized function (routes are compiled and the thread
+    pool is shut down automatically), functions registered with
+    `after_restore` run when an environment is resumed from it (random is
+    reseeded automatically). See `lambdarest.testing.simulate_snapshot_restore`.
+
+    Blueprints:
+    Routes can be grouped in `Blueprint`s mounted under a single segment path
+    prefix with `mount`. Requests are dispatched on their first path segment
+    to the blueprint owning it, whose routes are only compiled on its first
+    request (or when warming up), so unused routes cost nothing on cold starts.
+
+    Error handlers:
+    Functions registered with `errorhandler(ExceptionType)` turn exceptions of
+    that type (or subtypes, resolved through the MRO once per type) into
+    responses, which pass through the after request handlers, exceptions
+    raised by them are logged and answered like unhandled ones. Other
+    exceptions are passed to `error_handler`, the tracebacks of the default
+    one are logged at most `error_log_rate` times per second (None for no
+    limit) and the rest counted in `lambda_handler.metrics["errors"]`.
+
+    Access log:
+    With an `AccessLog` as `access_log` every request is recorded as one
+    structured json line (sampled per status) written at the end of the
+    invocation, replacing the warnings logged for 4xx responses.
+
+    Base path:
+    Requests through a custom domain carry its base path in `event["path"]`.
+    By default it is detected by comparing the first path segments of path
+    and resource, a known `base_path` (eg. "/v2") is stripped instead.
+
+    Coalescing:
+    Handlers registered with a `coalesce_key` share one call between
+    concurrent requests (eg. on the threads of a local server or of
+    `submit`/`map`): requests arriving while a request with the same
+    `coalesce_key(event, **path_params)` is being handled wait for and get a
+    copy of its response. There is no default key, it has to include
+    whatever identifies the caller (cookies, api keys, authorizer claims)
+    if responses depend on it. Counts are kept per route in
+    `lambda_handler.metrics["coalescing"]`.
+
+    Load shedding:
+    Handlers registered with a `rate_limit` (requests per second per
+    container, with bursts of `burst`) answer requests over the limit with
+    429, and with `max_concurrency` requests beyond that many in flight are
+    answered with 503, both with a `Retry-After` header and before any
+    handler runs. Counts are kept per route in `lambda_handler.metrics["limits"]`.
+
+    Route cache:
+    Route matches, including not found and method not allowed results, are
+    kept in an LRU cache of `route_cache_size` entries keyed on the method and
+    the normalized path (0 disables it). It is cleared whenever routes are
+    added, `lambda_handler.route_cache_info()` returns its statistics.
+
+    Inner_batch_handler:
+    Dispatches the records of SQS, Kinesis and DynamoDB Streams events to the
+    functions registered with `handle_record`, processing them concurrently on
+    a thread pool of at most `max_workers` threads which is kept alive across
+    warm invocations. Records of ordered sources are processed one after
+    another per Kinesis partition key, DynamoDB item or FIFO message group,
+    and once one of them fails the rest of its group is failed unprocessed.
+    Records without a matching handler are failed (`unmatched_records="fail"`)
+    or logged and skipped (`"skip"`).
+
     """
     url_maps = Map()
+    if base_path is not None:
+        base_path = "/" + base_path.strip("/")
+    # first path segment -> [blueprint, prefix, compiled Map or None]
+    mounts = {}
+    mounts_lock = Lock()
+    default_response_validation_rate = response_validation_rate
+    default_validation = validation
+    default_validation_sample_rate = validation_sample_rate
+    default_max_body_bytes = max_body_bytes
+    default_max_part_bytes = max_part_bytes
+    # compile steps of the route handlers, run when warming up or snapshotting
+    route_compilers = []
     before_request_handlers: List[BeforeRequestCallable] = []
     after_request_handlers: List[AfterRequestCallable] = []
+    preflight_handlers: List[PreflightCallable] = []
+    record_handlers = []
+    if unmatched_records not in ("fail", "skip"):
+        raise ValueError("unmatched_records must be 'fail' or 'skip'")
+    if prime_on_warmup not in (True, False, "always"):
+        raise ValueError("prime_on_warmup must be True, False or 'always'")
+    executor = []
+    executor_lock = Lock()
+    # set once the container has been primed
+    primed = []
+    request_scope = local()
+    metrics = {
+        "tasks": {},
+        "coalescing": {},
+        "limits": {},
+        "response_validation": {"sampled": 0, "violations": 0},
+        "errors": {"handled": 0, "logged": 0, "suppressed": 0},
+    }
+    metrics_lock = Lock()
+    prime_functions = []
+    error_handlers = {}
+    error_handler_cache = {}
+    error_log_bucket = None if error_log_rate is None else TokenBucket(error_log_rate)
+    before_snapshot_hooks = []
+    after_restore_hooks = []
+
+    def mark_pool_thread():
+        request_scope.pool_thread = True
+
+    def get_executor():
+        # one pool per container, created on first use and reused while warm
+        if not executor:
+            with executor_lock:
+                if not executor:
+                    executor.append(
+                        ThreadPoolExecutor(
+                            max_workers=max_workers, initializer=mark_pool_thread
+                        )
+                    )
+        return executor[0]
+
+    def find_record_handler(record):
+        for event_source, attributes, func in record_handlers:
+            if event_source is not None and record.get("eventSource") != event_source:
+                continue
+            if all(
+                __record_attribute(record, name) == value for name, value in attributes
+            ):
+                return func
+        return None
 
-    def inner_lambda_handler(event, context=None):
-        apply_after_request_handlers = __pipe_funcs(*after_request_handlers)
+    def process_record(record):
+        func = find_record_handler(record)
+        if func is None:
+            logging.warning(
+                "[%s]: no record handler registered", record.get("eventSource")
+            )
+            return unmatched_records == "skip"
+        try:
+            func(record)
+        except Exception as error:
+            if not error_handler:
+                raise
+            # rate limited like the errors of http handlers
+            log_error(error, record.get("eventSource"))
+            return False
+        return True
+
+    def record_task_timing(name, duration_ms):
+        with metrics_lock:
+            timing = metrics["tasks"].setdefault(
+                name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0}
+            )
+            timing["count"] += 1
+            timing["total_ms"] += duration_ms
+            timing["max_ms"] = max(timing["max_ms"], duration_ms)
 
-        # check if running as "aws lambda proxy"
+    def count(section, key):
+        with metrics_lock:
+            metrics[section][key] += 1
+
+    def compile_coalescer(func, coalesce_key, counters):
+        """Wraps `func` so concurrent calls with the same key share one call"""
+        in_flight = {}
+        in_flight_lock = Lock()
+
+        @wraps(func)
+        def coalesced(event, *args, **kwargs):
+            key = coalesce_key(event, **kwargs)
+            with in_flight_lock:
+                call = in_flight.get(key)
+                leader = call is None
+                if leader:
+                    call = in_flight[key] = Future()
+
+            if not leader:
+                response = call.result()
+                if isinstance(response, StreamingResponse):
+                    # an iterator can only be consumed once
+                    return func(event, *args, **kwargs)
+                with metrics_lock:
+                    counters["coalesced"] += 1
+                # after request handlers may change the headers of a response
+                return __copy_response(response)
+
+            with metrics_lock:
+                counters["executed"] += 1
+            try:
+                response = __to_response(func(event, *args, **kwargs))
+            except BaseException as error:
+                call.set_exception(error)
+                raise
+            else:
+                # published before the leader's after request handlers run
+                call.set_result(
+                    response
+                    if isinstance(response, StreamingResponse)
+                    else __copy_response(response)
+                )
+                return response
+            finally:
+                with in_flight_lock:
+                    del in_flight[key]
+
+        return coalesced
+
+    def compile_limiter(route, rate_limit, burst, max_concurrency, retry_after):
+        """Returns the functions admitting and releasing requests of a route"""
+        stats = metrics["limits"].setdefault(
+            route, {"admitted": 0, "throttled": 0, "shed": 0, "in_flight": 0}
+        )
+        bucket = None if rate_limit is None else TokenBucket(rate_limit, burst)
+        slots = None if max_concurrency is None else BoundedSemaphore(max_concurrency)
+
+        def admit():
+            if bucket is not None and not bucket.consume():
+                with metrics_lock:
+                    stats["throttled"] += 1
+                wait = max(1, math.ceil(bucket.retry_after()))
+                return Response("Too Many Requests", 429, {"Retry-After": str(wait)})
+            if slots is not None and not slots.acquire(blocking=False):
+                with metrics_lock:
+                    stats["shed"] += 1
+                return Response(
+                    "Service Unavailable", 503, {"Retry-After": str(retry_after)}
+                )
+            with metrics_lock:
+                stats["admitted"] += 1
+                stats["in_flight"] += 1
+            return None
+
+        def release():
+            with metrics_lock:
+                stats["in_flight"] -= 1
+            if slots is not None:
+                slots.release()
+
+        return admit, release
+
+    def compile_response_validator(response_schema, rate, method_name, path):
+        validator = validator_for(response_schema)(response_schema, **__validate_kwargs)
+
+        def validate_response(body):
+            if random.random() >= rate or isinstance(body, str):
+                return
+            count("response_validation", "sampled")
+            error = best_match(validator.iter_errors(body))
+            if error is not None:
+                count("response_validation", "violations")
+                logging.warning(
+                    "[%s][%s]: response violates schema[%s]: %s",
+                    method_name,
+                    path,
+                    "][".join(str(part) for part in error.absolute_schema_path),
+                    error.message,
+                )
+
+        return validate_response
+
+    def compile_request_validator(schema, mode, rate):
+        if mode not in ("always", "sampled", "structural"):
+            raise ValueError("validation must be 'always', 'sampled' or 'structural'")
+        if mode == "structural":
+            return __compile_structural_check(schema)
+
+        validators = []
+
+        def compile_validator():
+            if not validators:
+                cls = validator_for(schema)
+                cls.check_schema(schema)
+                validators.append(cls(schema, **__validate_kwargs))
+            return validators[0]
+
+        route_compilers.append(compile_validator)
+
+        def validate_request(json_data):
+            error = best_match(compile_validator().iter_errors(json_data))
+            if error is not None:
+                raise error
+
+        if mode == "always":
+            return validate_request
+
+        def validate_sampled_request(json_data):
+            if random.random() < rate:
+                validate_request(json_data)
+
+        return validate_sampled_request
+
+    def submit(fn, *args, **kwargs):
+        """Runs `fn(*args, **kwargs)` on the pool as part of the current request"""
+        name = getattr(fn, "__name__", repr(fn))
+
+        def timed():
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_task_timing(name, (time.perf_counter() - start) * 1000.0)
+
+        if getattr(request_scope, "pool_thread", False):
+            # all threads of the pool could end up waiting for queued tasks
+            future = Future()
+            try:
+                future.set_result(timed())
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        future = get_executor().submit(timed)
+        futures = getattr(request_scope, "futures", None)
+        if futures is not None:
+            futures.append(future)
+        return future
+
+    def map_tasks(fn, *iterables, timeout=None):
+        """Like `Executor.map` but bounded by the invocation deadline
+
+        Raises `concurrent.futures.TimeoutError` if the results are not ready
+        before `timeout` seconds or the deadline of the invocation.
+        """
+        futures = [submit(fn, *args) for args in zip(*iterables)]
+        deadline = getattr(request_scope, "deadline", None)
+        if timeout is not None:
+            deadline = min(deadline or float("inf"), time.monotonic() + timeout)
+
+        results = []
+        for future in futures:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            try:
+                results.append(future.result(timeout=remaining))
+            except TimeoutError:
+                for pending in futures:
+                    pending.cancel()
+                raise
+        return results
+
+    def release_request_scope():
+        futures = request_scope.futures
+        request_scope.futures = request_scope.deadline = request_scope.event = None
+        request_scope.route = None
+        unfinished = [future for future in futures if not future.done()]
+        if unfinished:
+            cancelled = sum(1 for future in unfinished if future.cancel())
+            logging.warning(
+                "%s task(s) unfinished at end of request, %s cancelled",
+                len(unfinished),
+                cancelled,
+            )
+
+    def process_group(records):
+        results = []
+        for record in records:
+            if results and not results[-1]:
+                # later records of an ordered group must not overtake a failed one
+                results.append(False)
+            else:
+                results.append(process_record(record))
+        return results
+
+    def inner_batch_handler(event, context=None):
+        records = event.get("Records") or []
+        groups = []
+        ordered_groups = {}
+        for index, record in enumerate(records):
+            key = __record_group(record)
+            if key is None:
+                groups.append([index])
+            elif key in ordered_groups:
+                ordered_groups[key].append(index)
+            else:
+                ordered_groups[key] = [index]
+                groups.append(ordered_groups[key])
+        record_groups = [[records[index] for index in group] for group in groups]
+
+        if (
+            len(groups) > 1
+            and max_workers > 1
+            and not getattr(request_scope, "pool_thread", False)
+        ):
+            results = list(get_executor().map(process_group, record_groups))
+        else:
+            results = [process_group(group) for group in record_groups]
+
+        failed = set()
+        for group, processed in zip(groups, results):
+            failed.update(index for index, ok in zip(group, processed) if not ok)
+        return {
+            "batchItemFailures": [
+                {"itemIdentifier": __record_identifier(records[index])}
+                for index in sorted(failed)
+            ]
+        }
+
+    def find_error_handler(error_type):
+        try:
+            return error_handler_cache[error_type]
+        except KeyError:
+            pass
+        handler = None
+        for klass in error_type.__mro__:
+            if klass in error_handlers:
+                handler = error_handlers[klass]
+                break
+        error_handler_cache[error_type] = handler
+        return handler
+
+    def handle_error(error):
+        """Returns the response of the error handler registered for the error,
+        None if there is none or it failed"""
+        handler = find_error_handler(type(error)) if error_handlers else None
+        if handler is None:
+            return None
+        try:
+            response = __to_response(handler(error))
+        except Exception:
+            logging.exception("error handler for %s failed", type(error).__name__)
+            return None
+        count("errors", "handled")
+        return response
+
+    def log_error(error, method_name):
+        # only the tracebacks of the default handler are rate limited, custom
+        # handlers may report to error trackers and see every exception
         if (
-            not isinstance(event, dict)
-            or not all(key in event for key in __required_keys)
-            or not any(key in event for key in __either_keys)
+            error_log_bucket is None
+            or error_handler is not default_error_handler
+            or error_log_bucket.consume()
         ):
+            count("errors", "logged")
+            error_handler(error, method_name)
+        else:
+            count("errors", "suppressed")
+
+    def warn(method_name, status_code, message, *args):
+        # the access log records the status of every request instead
+        if access_log is None:
+            logging.warning("[%s][%s]: " + message, method_name, status_code, *args)
+
+    def default_error_tuple(error, method_name):
+        if isinstance(error, ValidationError):
+            warn(
+                method_name,
+                400,
+                "Schema[%s] with value %s",
+                "][".join(str(error.absolute_schema_path)),
+                error.message,
+            )
+            return ("Validation Error", 400)
+
+        if isinstance(error, ScopeMissing):
+            error_description = "Permission denied"
+            warn(method_name, 403, error_description)
+            return (error_description, 403)
+
+        if isinstance(error, HTTPException):
+            warn(method_name, error.code, error.name)
+            return (error.description, error.code)
+
+        if not error_handler:
+            raise error
+        log_error(error, method_name)
+        return ("Internal server error", 500)
+
+    @lru_cache(maxsize=route_cache_size)
+    def match_route(routes, path, method_name):
+        # bind the mapping to an empty server name
+        try:
+            rule, kwargs = routes.bind("").match(
+                path, method=method_name, return_rule=True
+            )
+        except HTTPException as e:
+            # eg. NotFound or MethodNotAllowed
+            return None, None, e
+
+        # if this is a catch-all rule, don't send any kwargs
+        if rule.endpoint.catch_all or rule.rule == "/<path:path>":
+            kwargs = {}
+        return rule, kwargs, None
+
+    def compile_mount(mount):
+        with mounts_lock:
+            if mount[2] is None:
+                blueprint, prefix, _ = mount
+                routes = Map()
+                for method_name, path, options, func in blueprint.routes:
+                    rule = build_route(
+                        method_name, __prefix_path(prefix, path), **options
+                    )(func)
+                    # the blueprint's catch-all, below its prefix
+                    rule.endpoint.catch_all = path in ("*", "/*")
+                    routes.add(rule)
+                routes.update()
+                mount[2] = routes
+            return mount[2]
+
+    def compile_routes():
+        for mount in list(mounts.values()):
+            compile_mount(mount)
+        url_maps.update()
+        for compile_route in route_compilers:
+            compile_route()
+
+    def warm():
+        """Compiles the routes and runs the registered prime functions"""
+        compile_routes()
+        for func in prime_functions:
+            try:
+                func()
+            except Exception:
+                logging.exception("prime function %s failed", func.__name__)
+        primed[:] = [True]
+
+    def shutdown_executor():
+        # threads do not survive a snapshot, the pool is recreated on first use
+        with executor_lock:
+            if executor:
+                executor.pop().shutdown(wait=True)
+
+    def run_before_snapshot():
+        for func in before_snapshot_hooks:
+            func()
+        compile_routes()
+        shutdown_executor()
+
+    def run_after_restore():
+        # restored environments would otherwise share the snapshotted random state
+        random.seed()
+        # caches and pools filled before the snapshot may be stale
+        del primed[:]
+        for func in after_restore_hooks:
+            func()
+
+    def inner_lambda_handler(event, context=None):
+        if isinstance(event, dict) and __is_warmup_event(event):
+            if prime_on_warmup == "always" or (prime_on_warmup and not primed):
+                warm()
+            return {"warmed": True}
+
+        # queue and stream batches are dispatched to the record handlers
+        if record_handlers and isinstance(event, dict) and "Records" in event:
+            return inner_batch_handler(event, context)
+
+        request_scope.event = event
+        request_scope.futures = []
+        request_scope.deadline = __deadline(context)
+        request_scope.route = None
+        if access_log is None:
+            try:
+                return dispatch_request(event, context)
+            finally:
+                release_request_scope()
+
+        started = time.perf_counter()
+        try:
+            result = dispatch_request(event, context)
+            access_log.record(
+                event,
+                context,
+                request_scope.route,
+                result.get("statusCode"),
+                (time.perf_counter() - started) * 1000,
+            )
+            return result
+        finally:
+            release_request_scope()
+            access_log.flush()
+
+    def dispatch_request(event, context):
+        # check if running as "aws lambda proxy"
+        method, event_path = (
+            _request_line(event) if isinstance(event, dict) else (None, None)
+        )
+        if method is None or (event_path is None and "resource" not in event):
             message = "Bad request, maybe not using Lambda Proxy?"
             logging.error(message)
             return Response(message, 500).to_json(
                 application_load_balancer=application_load_balancer
             )
 
-        # Save context within event for easy access
-        event["context"] = context
         # for application load balancers, no api definition is used hence no resource is set so just use path
         if "resource" not in event:
-            resource = event["path"]
+            resource = event_path
         else:
             resource = event["resource"]
 
@@ -299,6 +2046,15 @@ def create_lambda_handler(
 
         path = resource
 
+        if base_path is not None:
+            # a known base path is stripped from the path in a single slice
+            if event_path is not None and event_path.startswith(base_path):
+                rest = event_path[len(base_path) :]
+                if not rest:
+                    path = "/"
+                elif rest[0] == "/":
+                    path = rest
+
         # Check if a path is set, if so, check if the base path is the same as
         # the resource. If not, this is an api with a custom domainname.
         # if so, the path will contain the actual request, but it will be
@@ -308,35 +2064,64 @@ def create_lambda_handler(
         # path: /v2/foo/foobar
         # resource: /foo/{name}
         # the /v2 needs to be removed
-        if "path" in event and event["path"].split("/")[1] != resource.split("/")[1]:
-            path = "/%s" % "/".join(event["path"].split("/")[2:])
+        elif event_path is not None:
+            first_segment, _, rest = event_path[1:].partition("/")
+            if first_segment != resource[1:].partition("/")[0]:
+                path = "/" + rest
 
         # proxy is a bit weird. We just replace the value in the uri with the
         # actual value provided by apigw, and use that
         if "{proxy+}" in resource:
             path = resource.replace("{proxy+}", event["pathParameters"]["proxy"])
 
-        method_name = event["httpMethod"].lower()
+        method_name = method.lower()
+
+        # requests below a mounted prefix are only matched against its blueprint
+        mount = mounts.get(path[1:].partition("/")[0]) if mounts else None
+        if mount is None:
+            routes = url_maps
+            before_handlers = before_request_handlers
+            after_handlers = after_request_handlers
+        else:
+            routes = mount[2] or compile_mount(mount)
+            blueprint = mount[0]
+            before_handlers = (
+                before_request_handlers + blueprint.before_request_handlers
+            )
+            after_handlers = blueprint.after_request_handlers + after_request_handlers
+        apply_after_request_handlers = __pipe_funcs(*after_handlers)
+
+        # answer CORS preflights for routes without their own OPTIONS handler
+        if method_name == "options" and preflight_handlers:
+            allowed_methods = routes.bind("").allowed_methods(path)
+            if allowed_methods and "OPTIONS" not in allowed_methods:
+                return preflight_handlers[-1](event, allowed_methods).to_json(
+                    application_load_balancer=application_load_balancer
+                )
+
         func = None
-        kwargs = {}
+        error_response = None
         error_tuple = ("Internal server error", 500)
-        logging_message = "[%s][{status_code}]: {message}" % method_name
-        try:
-            # bind the mapping to an empty server name
-            mapping = url_maps.bind("")
-            rule, kwargs = mapping.match(path, method=method_name, return_rule=True)
+        rule, kwargs, e = match_route(routes, path, method_name)
+        if e is None:
             func = rule.endpoint
-
-            # if this is a catch-all rule, don't send any kwargs
-            if rule.rule == "/<path:path>":
-                kwargs = {}
-        except NotFound as e:
-            logging.warning(logging_message.format(status_code=404, message=str(e)))
-            error_tuple = (str(e), 404)
+            request_scope.route = rule.rule
+        else:
+            error_response = handle_error(e)
+            if error_response is None:
+                warn(method_name, e.code, "%s", e)
+                error_tuple = (str(e), e.code)
+
+        # overloaded routes are answered before any handler runs
+        if func and func.admit is not None:
+            error_response = func.admit()
+            if error_response is not None:
+                warn(method_name, error_response.status_code, "%s", error_response.body)
+                func = None
 
         if func:
             try:
-                for handler in before_request_handlers:
+                for handler in before_handlers:
                     # pylint: disable=E1128
                     response = handler()
                     if response:
@@ -344,136 +2129,228 @@ def create_lambda_handler(
                             application_load_balancer=application_load_balancer
                         )
 
-                response = func(event, **kwargs)
-                if not isinstance(response, Response):
-                    # Set defaults
-                    status_code = headers = multiValueHeaders = None
-                    isBase64Encoded = False
-
-                    if isinstance(response, tuple):
-                        response_len = len(response)
-                        if response_len > 3:
-                            raise ValueError("Response tuple has more than 3 items")
-
-                        # Unpack the tuple, missing items will be defaulted
-                        body, status_code, headers, multiValueHeaders = response + (
-                            None,
-                        ) * (4 - response_len)
-
-                    elif isinstance(response, dict) and all(
-                        key
-                        in [
-                            "body",
-                            "statusCode",
-                            "headers",
-                            "multiValueHeaders",
-                            "statusDescription",
-                            "isBase64Encoded",
-                        ]
-                        for key in response.keys()
-                    ):
-                        body = response.get("body")
-                        status_code = response.get("statusCode") or status_code
-                        headers = response.get("headers") or headers
-                        multiValueHeaders = (
-                            response.get("multiValueHeaders") or multiValueHeaders
-                        )
-                        isBase64Encoded = (
-                            response.get("isBase64Encoded") or isBase64Encoded
-                        )
-
-                    else:  # if response is string, int, etc.
-                        body = response
-                    response = Response(
-                        body, status_code, headers, multiValueHeaders, isBase64Encoded
+                if func.wants_request:
+                    # cached kwargs are shared between requests
+                    request = Request(event, context, rule, dict(kwargs))
+                    response = func(request, **kwargs)
+                else:
+                    # Save context within event for easy access
+                    event["context"] = context
+                    response = func(event, **kwargs)
+
+                codec = __negotiate_codec(event)
+
+                # fast path for the common (body, status_code) tuple
+                if (
+                    type(response) is tuple
+                    and len(response) == 2
+                    and not after_handlers
+                    and codec is None
+                ):
+                    if func.validate_response:
+                        func.validate_response(response[0])
+                    return __tuple_to_json(
+                        response[0],
+                        response[1],
+                        json_encoder,
+                        application_load_balancer,
+                        func.serializer,
                     )
 
+                response = __to_response(response)
                 response = apply_after_request_handlers(response)
+                if func.validate_response and not isinstance(
+                    response, StreamingResponse
+                ):
+                    func.validate_response(response.body)
 
                 return response.to_json(
                     encoder=json_encoder,
                     application_load_balancer=application_load_balancer,
+                    serializer=func.serializer,
+                    codec=codec,
                 )
 
-            except ValidationError as error:
-                error_description = "Schema[{}] with value {}".format(
-                    "][".join(str(error.absolute_schema_path)), error.message
-                )
-                logging.warning(
-                    logging_message.format(status_code=400, message=error_description)
-                )
-                error_tuple = ("Validation Error", 400)
-
-            except ScopeMissing as error:
-                error_description = "Permission denied"
-                logging.warning(
-                    logging_message.format(status_code=403, message=error_description)
-                )
-                error_tuple = (error_description, 403)
-
-            except HTTPException as error:
-                logging.warning(
-                    logging_message.format(status_code=error.code, message=error.name)
-                )
-                error_tuple = (error.description, error.code)
-
             except Exception as error:
-                if error_handler:
-                    error_handler(error, method_name)
-                else:
-                    raise
-
-        body, status_code = error_tuple
-        response = apply_after_request_handlers(Response(body, status_code))
-
-        return response.to_json(application_load_balancer=application_load_balancer)
+                error_response = handle_error(error)
+                if error_response is None:
+                    error_tuple = default_error_tuple(error, method_name)
+
+            finally:
+                if func.release is not None:
+                    func.release()
+
+        if error_response is None:
+            error_response = Response(*error_tuple)
+        response = apply_after_request_handlers(error_response)
+
+        return response.to_json(
+            encoder=json_encoder, application_load_balancer=application_load_balancer
+        )
+
+    def build_route(
+        method_name,
+        path="/",
+        schema=None,
+        load_json=True,
+        scopes=None,
+        scopes_mode="all",
+        scopes_wildcards=False,
+        scopes_separator=".",
+        request=False,
+        response_schema=None,
+        response_validation_rate=None,
+        validation=None,
+        validation_sample_rate=None,
+        max_body_bytes=None,
+        max_part_bytes=None,
+        coalesce_key=None,
+        rate_limit=None,
+        burst=None,
+        max_concurrency=None,
+        retry_after=1,
+    ):
+        _check_route_options(
+            schema=schema,
+            load_json=load_json,
+            scopes_mode=scopes_mode,
+            scopes_wildcards=scopes_wildcards,
+            scopes_separator=scopes_separator,
+            validation=validation,
+            rate_limit=rate_limit,
+        )
+
+        if max_body_bytes is None:
+            max_body_bytes = default_max_body_bytes
+        if max_part_bytes is None:
+            max_part_bytes = default_max_part_bytes
+        form_parser = __form_parser(max_part_bytes, spool_threshold, max_body_bytes)
+
+        validate_request = None
+        if schema:
+            validate_request = compile_request_validator(
+                schema,
+                validation or default_validation,
+                default_validation_sample_rate
+                if validation_sample_rate is None
+                else validation_sample_rate,
+            )
 
-    def inner_handler(method_name, path="/", schema=None, load_json=True, scopes=None):
-        if schema and not load_json:
-            raise ValueError("if schema is supplied, load_json needs to be true")
+        missing_scope = (
+            __compile_scopes(scopes, scopes_mode, scopes_wildcards, scopes_separator)
+            if scopes
+            else None
+        )
 
-        query_param_schema = None
+        query_param_schema = body_param_schema = None
         if isinstance(schema, dict):
             query_param_schema = (
                 schema.get("properties", {}).get("query", {}).get("properties", {})
             )
+            body_param_schema = (
+                schema.get("properties", {}).get("body", {}).get("properties", {})
+            )
 
         def wrapper(func):
             @wraps(func)
             def inner(event, *args, **kwargs):
+                request_object = None
+                if request:
+                    request_object, event = event, event.event
+
+                if max_body_bytes is not None and __body_size(event) > max_body_bytes:
+                    raise RequestEntityTooLarge()
+
+                # base64 bodies are decoded once and shared with the handler
+                try:
+                    if request_object is not None and request_object.is_base64_encoded:
+                        body = request_object.data
+                    else:
+                        body = __decode_body(event)
+                except ValueError:
+                    return Response("Invalid base64 body", 400)
+                if request_object is None and isinstance(body, bytes):
+                    event["raw_body"] = memoryview(body)
+
+                if request_object is not None:
+                    # used when the body is only parsed by the handler
+                    request_object._form_parser = form_parser
+
                 if load_json:
                     try:
-                        json_body = json.loads(event.get("body") or "{}")
-                    except json.decoder.JSONDecodeError:
-                        return Response("Invalid json body", 400)
+                        json_body, form, files = _load_body(
+                            body,
+                            __get_header(event, "content-type"),
+                            form_parser,
+                            body_param_schema,
+                        )
+                    except BadRequest as e:
+                        return Response(e.description, 400)
+                    if form is not None and request_object is None:
+                        event["files"] = files
+                    elif form is not None:
+                        request_object._form = form
+                        request_object._files = files
+                    # repeated query params are only kept in the multi value form
+                    if request_object is not None:
+                        query = request_object.query
+                    elif event.get("multiValueQueryStringParameters"):
+                        query = _query_multi_dict(event)
+                    else:
+                        query = event.get("queryStringParameters")
                     json_data = {
                         "body": json_body,
                         "query": __json_load_query(
-                            event.get("queryStringParameters"),
-                            query_param_schema=query_param_schema,
+                            query, query_param_schema=query_param_schema
                         ),
                     }
-                    event["json"] = json_data
-                    if schema:
-                        # jsonschema.validate using given schema
-                        validate(json_data, schema, **__validate_kwargs)
-
-                try:
-                    provided_scopes = json.loads(
-                        event["requestContext"]["authorizer"]["scopes"]
-                    )
-                except KeyError:
-                    provided_scopes = []
-                except json.decoder.JSONDecodeError:
-                    # Ignore passed scopes if it isn't properly json encoded
-                    provided_scopes = []
-
-                for scope in scopes or []:
-                    if scope not in provided_scopes:
+                    if request_object is None:
+                        event["json"] = json_data
+                    else:
+                        request_object._json = json_data
+                    if validate_request:
+                        validate_request(json_data)
+
+                if missing_scope:
+                    scope = missing_scope(__provided_scopes(event))
+                    if scope is not None:
                         raise ScopeMissing("Scope: '{}' is missing".format(scope))
 
+                if request_object is not None:
+                    return func(request_object, *args, **kwargs)
                 return func(event, *args, **kwargs)
 
+            if coalesce_key is not None:
+                counters = metrics["coalescing"].setdefault(
+                    "%s %s" % (method_name.upper(), path),
+                    {"executed": 0, "coalesced": 0},
+                )
+                inner = compile_coalescer(inner, coalesce_key, counters)
+
+            inner.catch_all = path == "*"
+            inner.admit = inner.release = None
+            if rate_limit is not None or max_concurrency is not None:
+                inner.admit, inner.release = compile_limiter(
+                    "%s %s" % (method_name.upper(), path),
+                    rate_limit,
+                    burst,
+                    max_concurrency,
+                    retry_after,
+                )
+
+            inner.wants_request = request
+            inner.serializer = None
+            inner.validate_response = None
+            if response_schema:
+                inner.serializer = __compile_serializer(response_schema, json_encoder)
+                rate = response_validation_rate
+                if rate is None:
+                    rate = default_response_validation_rate
+                if rate > 0:
+                    inner.validate_response = compile_response_validator(
+                        response_schema, rate, method_name, path
+                    )
+
             # if this is a catch all url, make sure that it's setup correctly
             if path == "*":
                 target_path = "/*"
@@ -488,13 +2365,98 @@ def create_lambda_handler(
             if not target_path.startswith("/"):
                 raise ValueError("Please configure path with starting slash")
 
+            return Rule(target_path, endpoint=inner, methods=[method_name.lower()])
+
+        return wrapper
+
+    def inner_handler(method_name, path="/", **options):
+        build = build_route(method_name, path, **options)
+
+        def wrapper(func):
             # register http handler function
-            rule = Rule(target_path, endpoint=inner, methods=[method_name.lower()])
+            rule = build(func)
             url_maps.add(rule)
-            return inner
+            match_route.cache_clear()
+            return rule.endpoint
+
+        return wrapper
+
+    def mount(blueprint, prefix):
+        """Mounts the routes of a `Blueprint` under a single segment prefix
+
+        The prefix owns its first path segment, routes registered directly on
+        the handler below it are not reachable.
+        """
+        segment = prefix.strip("/")
+        if not prefix.startswith("/") or not segment or "/" in segment:
+            raise ValueError("Please configure prefix as a single path segment")
+        if "<" in segment or "*" in segment:
+            raise ValueError("Prefix can not contain placeholders")
+        if segment in mounts:
+            raise ValueError("A blueprint is already mounted at /%s" % segment)
+        mount_entry = mounts[segment] = [blueprint, "/" + segment, None]
+
+        def recompile():
+            with mounts_lock:
+                mount_entry[2] = None
+            match_route.cache_clear()
+
+        blueprint.listeners.append(recompile)
+        match_route.cache_clear()
+
+    def record_handler(event_source=None, attributes=None):
+        """Registers a function handling single records of a batch event
+
+        Records are matched on `eventSource` (eg. `lambdarest.SQS`) and on
+        `attributes`, a dict compared against the record's top level keys or
+        its SQS message attributes. The first matching handler wins, records
+        whose handler raises (and the records queued behind them in ordered
+        sources) are reported back in `batchItemFailures`.
+        """
+        attribute_items = tuple((attributes or {}).items())
+
+        def wrapper(func):
+            record_handlers.append((event_source, attribute_items, func))
+            return func
 
         return wrapper
 
+    def preflight_handler(func):
+        """Registers the function answering CORS preflight requests"""
+        preflight_handlers.append(func)
+        return func
+
+    def current_event():
+        """Returns the event of the request being handled by this thread"""
+        return getattr(request_scope, "event", None)
+
+    def errorhandler(error_type):
+        """Registers a function turning exceptions of `error_type` into responses"""
+        if not (isinstance(error_type, type) and issubclass(error_type, BaseException)):
+            raise ValueError("errorhandler expects an exception class")
+
+        def wrapper(func):
+            error_handlers[error_type] = func
+            error_handler_cache.clear()
+            return func
+
+        return wrapper
+
+    def prime_handler(func):
+        """Registers a function filling caches or opening pools on warmup"""
+        prime_functions.append(func)
+        return func
+
+    def before_snapshot_handler(func):
+        """Registers a function preparing state that belongs in the snapshot"""
+        before_snapshot_hooks.append(func)
+        return func
+
+    def after_restore_handler(func):
+        """Registers a function redoing per environment state after a restore"""
+        after_restore_hooks.append(func)
+        return func
+
     def after_request_handler(func):
         @wraps(func)
         def wrapper(request):
@@ -515,8 +2477,29 @@ def create_lambda_handler(
 
     lambda_handler = inner_lambda_handler
     lambda_handler.handle = inner_handler
+    lambda_handler.mount = mount
+    lambda_handler.route_cache_info = match_route.cache_info
     lambda_handler.before_request = before_request_handler
     lambda_handler.after_request = after_request_handler
+    lambda_handler.handle_record = record_handler
+    lambda_handler.handle_batch = inner_batch_handler
+    lambda_handler.submit = submit
+    lambda_handler.map = map_tasks
+    lambda_handler.metrics = metrics
+    lambda_handler.preflight = preflight_handler
+    lambda_handler.current_event = current_event
+    lambda_handler.prime = prime_handler
+    lambda_handler.errorhandler = errorhandler
+    lambda_handler.warm = warm
+    lambda_handler.before_snapshot = before_snapshot_handler
+    lambda_handler.after_restore = after_restore_handler
+    lambda_handler.run_before_snapshot = run_before_snapshot
+    lambda_handler.run_after_restore = run_after_restore
+
+    if register_before_snapshot is not None:
+        register_before_snapshot(run_before_snapshot)
+        register_after_restore(run_after_restore)
+
     return lambda_handler
 
 
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""Helpers for testing lambdarest handlers locally"""
+import base64
+import copy
+from json import dumps, loads
+
+from werkzeug.datastructures import Headers
+
+from .wsgi import EVENT_FORMATS, LocalContext
+
+# every client deep copies one of these, its events are shallow copies of that
+# copy with nested dicts only copied when changed
+_TEMPLATES = {
+    "v1": {
+        "httpMethod": "GET",
+        "path": "/",
+        "headers": {},
+        "multiValueHeaders": {},
+        "queryStringParameters": None,
+        "multiValueQueryStringParameters": None,
+        "pathParameters": None,
+        "requestContext": {"requestId": "test-request", "stage": "test"},
+        "body": None,
+        "isBase64Encoded": False,
+    },
+    "v2": {
+        "version": "2.0",
+        "routeKey": "$default",
+        "rawPath": "/",
+        "rawQueryString": "",
+        "headers": {},
+        "queryStringParameters": None,
+        "requestContext": {
+            "http": {"method": "GET", "path": "/"},
+            "requestId": "test-request",
+            "stage": "$default",
+        },
+        "body": None,
+        "isBase64Encoded": False,
+    },
+    "alb": {
+        "httpMethod": "GET",
+        "path": "/",
+        "headers": {},
+        "queryStringParameters": None,
+        "requestContext": {
+            "elb": {"targetGroupArn": "arn:aws:elasticloadbalancing:test"}
+        },
+        "body": None,
+        "isBase64Encoded": False,
+    },
+}
+
+
+def simulate_snapshot_restore(lambda_handler):
+    """Runs the snapshot and restore hooks of `lambda_handler` in the order the
+    lambda runtime would when an environment is restored from a snapshot.
+
+    example:
+        lambda_handler = create_lambda_handler()
+
+        @lambda_handler.after_restore
+        def connect():
+            ...
+
+        simulate_snapshot_restore(lambda_handler)
+        assert lambda_handler(event)["statusCode"] == 200
+    """
+    lambda_handler.run_before_snapshot()
+    lambda_handler.run_after_restore()
+    return lambda_handler
+
+
+class TestResponse(object):
+    """Decoded proxy response returned by `TestClient`"""
+
+    __slots__ = ("raw", "status_code", "headers", "body", "is_base64_encoded")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.status_code = raw.get("statusCode")
+        self.headers = Headers(raw.get("headers") or {})
+        for name, values in (raw.get("multiValueHeaders") or {}).items():
+            for value in values:
+                if value not in self.headers.getlist(name):
+                    self.headers.add(name, value)
+        self.body = raw.get("body")
+        self.is_base64_encoded = bool(raw.get("isBase64Encoded"))
+
+    @property
+    def data(self):
+        """The body as bytes, base64 decoded if needed"""
+        if self.body is None:
+            return b""
+        if self.is_base64_encoded:
+            return base64.b64decode(self.body)
+        return self.body.encode("utf-8")
+
+    def json(self):
+        return loads(self.data or b"null")
+
+
+class TestClient(object):
+    """Calls a lambda handler in-process with events built from templates
+
+    example:
+        client = TestClient(lambda_handler)
+        response = client.post("/items", json={"name": "foo"})
+        assert response.status_code == 200
+        assert response.json() == {"id": 1}
+
+    `event_format` is "v1" (REST api), "v2" (HTTP api) or "alb". Events are
+    shallow copies of the client's template, so building one allocates a
+    single dict plus whatever is passed in. For benchmarks, build the events once with
+    `build_event` and call the handler in a tight loop with `run`.
+
+    Each request gets a fresh `LocalContext` (its own request id and
+    deadline) unless a `context` is passed, which is then used for all.
+    """
+
+    __test__ = False  # not a pytest test class
+
+    def __init__(self, lambda_handler, event_format="v1", headers=None, context=None):
+        if event_format not in EVENT_FORMATS:
+            raise ValueError(
+                "event_format must be one of %s" % ", ".join(EVENT_FORMATS)
+            )
+        self.lambda_handler = lambda_handler
+        self.event_format = event_format
+        # nested dicts are shared by the events of this client only
+        self.template = copy.deepcopy(_TEMPLATES[event_format])
+        if headers:
+            self.template["headers"] = dict(headers)
+            if "multiValueHeaders" in self.template:
+                self.template["multiValueHeaders"] = {
+                    name: [value] for name, value in headers.items()
+                }
+        self.context = context
+
+    def new_context(self):
+        """Returns the lambda context of the next request"""
+        return self.context if self.context is not None else LocalContext()
+
+    def build_event(
+        self,
+        method,
+        path,
+        json=None,
+        body=None,
+        query=None,
+        headers=None,
+        path_parameters=None,
+        resource=None,
+    ):
+        """Returns the proxy event of a request
+
+        `query` is a dict or a list of (name, value) pairs, `body` a str or
+        bytes (sent base64 encoded), `json` is dumped into the body.
+        """
+        event = dict(self.template)
+        method = method.upper()
+
+        if json is not None:
+            body = dumps(json)
+        if isinstance(body, bytes):
+            event["body"] = base64.b64encode(body).decode("ascii")
+            event["isBase64Encoded"] = True
+        elif body is not None:
+            event["body"] = body
+
+        if headers:
+            event["headers"] = dict(event["headers"], **headers)
+            if "multiValueHeaders" in event:
+                multi_value_headers = dict(event["multiValueHeaders"])
+                for name, value in headers.items():
+                    multi_value_headers[name] = [value]
+                event["multiValueHeaders"] = multi_value_headers
+
+        if query:
+            items = query.items() if isinstance(query, dict) else query
+            multi_value_query = {}
+            for name, value in items:
+                multi_value_query.setdefault(name, []).append(str(value))
+            if self.event_format == "v2":
+                event["queryStringParameters"] = {
+                    name: ",".join(values) for name, values in multi_value_query.items()
+                }
+            else:
+                event["queryStringParameters"] = {
+                    name: values[-1] for name, values in multi_value_query.items()
+                }
+                if self.event_format == "v1":
+                    event["multiValueQueryStringParameters"] = multi_value_query
+
+        if self.event_format == "v2":
+            event["rawPath"] = path
+            request_context = dict(event["requestContext"])
+            request_context["http"] = {"method": method, "path": path}
+            event["requestContext"] = request_context
+        else:
+            event["httpMethod"] = method
+            event["path"] = path
+        if resource is not None:
+            event["resource"] = resource
+        if path_parameters is not None:
+            event["pathParameters"] = path_parameters
+        return event
+
+    def request(self, method, path, **kwargs):
+        """Calls the handler with the event of a request, see `build_event`"""
+        return TestResponse(
+            self.lambda_handler(
+                self.build_event(method, path, **kwargs), self.new_context()
+            )
+        )
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def head(self, path, **kwargs):
+        return self.request("HEAD", path, **kwargs)
+
+    def options(self, path, **kwargs):
+        return self.request("OPTIONS", path, **kwargs)
+
+    def run(self, events, repeat=1):
+        """Calls the handler with each of `events`, `repeat` times, and returns
+        the raw proxy responses of the last round
+
+        The events are passed as they are, the handler only replaces the top
+        level keys it adds (like "json") so they can be reused. All calls
+        share one context.
+        """
+        lambda_handler = self.lambda_handler
+        context = self.new_context()
+        results = []
+        for _ in range(repeat):
+            results = [lambda_handler(event, context) for event in events]
+        return results
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""Serve a lambdarest handler over HTTP for local load testing and profiling
+
+HTTP requests are converted into API Gateway REST api ("v1"), HTTP api
+("v2") or Application Load Balancer ("alb") proxy events, passed to the
+handler and its proxy response is converted back.
+
+example:
+    from lambdarest.wsgi import serve
+    from my_service import lambda_handler
+
+    serve(lambda_handler, port=8000, threaded=True)
+
+or from the command line:
+    python -m lambdarest.wsgi my_service:lambda_handler --port 8000
+"""
+import argparse
+import asyncio
+import base64
+import importlib
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+from werkzeug.http import HTTP_STATUS_CODES
+
+EVENT_FORMATS = ("v1", "v2", "alb")
+
+
+class LocalContext(object):
+    """Minimal stand in for the lambda context object"""
+
+    __slots__ = ("aws_request_id", "function_name", "deadline")
+
+    def __init__(self, function_name="lambdarest-local", timeout=30.0):
+        self.aws_request_id = str(uuid.uuid4())
+        self.function_name = function_name
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+def __query_items(query_string, event_format):
+    if not query_string:
+        return []
+    if event_format == "alb":
+        # load balancers pass the query parameters on without decoding them
+        return [
+            tuple(item.split("=", 1)) if "=" in item else (item, "")
+            for item in query_string.split("&")
+            if item
+        ]
+    return parse_qsl(query_string, keep_blank_values=True)
+
+
+def __multi_dict(items):
+    multi = {}
+    for key, value in items:
+        multi.setdefault(key, []).append(value)
+    return multi
+
+
+def build_event(
+    method,
+    path,
+    query_string="",
+    headers=(),
+    body=b"",
+    event_format="v1",
+    request_id=None,
+    source_ip="127.0.0.1",
+):
+    """Builds the proxy event of an HTTP request
+
+    `headers` are (name, value) pairs, `body` bytes. Bodies which are not
+    valid utf-8 are base64 encoded.
+    """
+    if event_format not in EVENT_FORMATS:
+        raise ValueError("event_format must be one of %s" % ", ".join(EVENT_FORMATS))
+
+    try:
+        body_text = body.decode("utf-8") if body else None
+        is_base64_encoded = False
+    except UnicodeDecodeError:
+        body_text = base64.b64encode(body).decode("ascii")
+        is_base64_encoded = True
+
+    query_items = __query_items(query_string, event_format)
+    request_id = request_id or str(uuid.uuid4())
+
+    if event_format == "v2":
+        header_values = __multi_dict((name.lower(), value) for name, value in headers)
+        cookies = header_values.pop("cookie", None)
+        event = {
+            "version": "2.0",
+            "routeKey": "$default",
+            "rawPath": path,
+            "rawQueryString": query_string,
+            "headers": {
+                name: ",".join(values) for name, values in header_values.items()
+            },
+            "queryStringParameters": {
+                key: ",".join(values)
+                for key, values in __multi_dict(query_items).items()
+            }
+            or None,
+            "requestContext": {
+                "http": {
+                    "method": method,
+                    "path": path,
+                    "protocol": "HTTP/1.1",
+                    "sourceIp": source_ip,
+                    "userAgent": header_values.get("user-agent", [""])[0],
+                },
+                "requestId": request_id,
+                "routeKey": "$default",
+                "stage": "$default",
+            },
+            "body": body_text,
+            "isBase64Encoded": is_base64_encoded,
+        }
+        if cookies:
+            event["cookies"] = [
+                cookie.strip()
+                for value in cookies
+                for cookie in value.split(";")
+                if cookie.strip()
+            ]
+        return event
+
+    if event_format == "alb":
+        headers = [(name.lower(), value) for name, value in headers]
+        request_context = {
+            "elb": {"targetGroupArn": "arn:aws:elasticloadbalancing:local"}
+        }
+    else:
+        request_context = {
+            "httpMethod": method,
+            "path": path,
+            "requestId": request_id,
+            "stage": "local",
+            "identity": {"sourceIp": source_ip},
+        }
+
+    multi_value_headers = __multi_dict(headers)
+    multi_value_query = __multi_dict(query_items)
+    return {
+        "httpMethod": method,
+        "path": path,
+        "headers": {name: values[-1] for name, values in multi_value_headers.items()},
+        "multiValueHeaders": multi_value_headers,
+        "queryStringParameters": {
+            key: values[-1] for key, values in multi_value_query.items()
+        }
+        or None,
+        "multiValueQueryStringParameters": multi_value_query or None,
+        "pathParameters": None,
+        "requestContext": request_context,
+        "body": body_text,
+        "isBase64Encoded": is_base64_encoded,
+    }
+
+
+def parse_response(result):
+    """Converts a proxy response into a status line, (name, value) header pairs
+    and the body as bytes"""
+    # load balancer responses carry a statusDescription like "HTTP OK", which
+    # is not a valid status line
+    status_code = int(result.get("statusCode") or 200)
+    status = "%s %s" % (status_code, HTTP_STATUS_CODES.get(status_code, "UNKNOWN"))
+
+    headers = list((result.get("headers") or {}).items())
+    for name, values in (result.get("multiValueHeaders") or {}).items():
+        headers.extend((name, value) for value in values)
+    headers.extend(("Set-Cookie", cookie) for cookie in result.get("cookies") or ())
+    headers = [(name, str(value)) for name, value in headers]
+
+    body = result.get("body") or ""
+    if result.get("isBase64Encoded"):
+        body = base64.b64decode(body)
+    elif isinstance(body, str):
+        body = body.encode("utf-8")
+    if not any(name.lower() == "content-length" for name, _ in headers):
+        headers.append(("Content-Length", str(len(body))))
+    return status, headers, body
+
+
+class WSGIAdapter(object):
+    """WSGI application calling `lambda_handler` with proxy events"""
+
+    def __init__(self, lambda_handler, event_format="v1", timeout=30.0):
+        if event_format not in EVENT_FORMATS:
+            raise ValueError(
+                "event_format must be one of %s" % ", ".join(EVENT_FORMATS)
+            )
+        self.lambda_handler = lambda_handler
+        self.event_format = event_format
+        self.timeout = timeout
+
+    def __call__(self, environ, start_response):
+        headers = [
+            (key[5:].replace("_", "-").title(), value)
+            for key, value in environ.items()
+            if key.startswith("HTTP_")
+        ]
+        for key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            if environ.get(key):
+                headers.append((key.replace("_", "-").title(), environ[key]))
+
+        length = int(environ.get("CONTENT_LENGTH") or 0)
+        body = environ["wsgi.input"].read(length) if length else b""
+
+        context = LocalContext(timeout=self.timeout)
+        event = build_event(
+            environ["REQUEST_METHOD"],
+            # PATH_INFO is decoded as latin-1 by the server
+            environ.get("PATH_INFO", "").encode("latin-1").decode("utf-8") or "/",
+            environ.get("QUERY_STRING", ""),
+            headers,
+            body,
+            self.event_format,
+            context.aws_request_id,
+            environ.get("REMOTE_ADDR", "127.0.0.1"),
+        )
+        status, response_headers, response_body = parse_response(
+            self.lambda_handler(event, context)
+        )
+        start_response(status, response_headers)
+        return [response_body]
+
+
+class ASGIAdapter(object):
+    """ASGI application calling `lambda_handler` with proxy events
+
+    The handler is blocking, so it runs on the default executor of the
+    event loop.
+    """
+
+    def __init__(self, lambda_handler, event_format="v1", timeout=30.0):
+        if event_format not in EVENT_FORMATS:
+            raise ValueError(
+                "event_format must be one of %s" % ", ".join(EVENT_FORMATS)
+            )
+        self.lambda_handler = lambda_handler
+        self.event_format = event_format
+        self.timeout = timeout
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            raise ValueError("Unsupported ASGI scope type %s" % scope["type"])
+
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        context = LocalContext(timeout=self.timeout)
+        event = build_event(
+            scope["method"],
+            scope["path"],
+            scope.get("query_string", b"").decode("latin-1"),
+            [
+                (name.decode("latin-1"), value.decode("latin-1"))
+                for name, value in scope.get("headers", [])
+            ],
+            b"".join(chunks),
+            self.event_format,
+            context.aws_request_id,
+            (scope.get("client") or ("127.0.0.1",))[0],
+        )
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, self.lambda_handler, event, context
+        )
+        status, headers, body = parse_response(result)
+        await send(
+            {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def serve(
+    lambda_handler,
+    host="127.0.0.1",
+    port=5000,
+    event_format="v1",
+    threaded=True,
+    processes=1,
+    **options,
+):
+    """Serves `lambda_handler` with the werkzeug development server
+
+    Requests are handled on a thread each (`threaded`) or by a pool of
+    forked `processes`, werkzeug does not support both at the same time.
+    Other keyword arguments are passed on to `werkzeug.serving.run_simple`.
+    """
+    from werkzeug.serving import run_simple
+
+    run_simple(
+        host,
+        port,
+        WSGIAdapter(lambda_handler, event_format),
+        threaded=threaded and processes == 1,
+        processes=processes,
+        **options,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m lambdarest.wsgi",
+        description="Serve a lambdarest handler over HTTP",
+    )
+    parser.add_argument("handler", help="handler to serve, eg. my_service:handler")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--event-format", choices=EVENT_FORMATS, default="v1")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="number of forked worker processes, threads are used when 1",
+    )
+    args = parser.parse_args(argv)
+
+    module_name, _, attribute = args.handler.partition(":")
+    lambda_handler = getattr(
+        importlib.import_module(module_name), attribute or "lambda_handler"
+    )
+    serve(
+        lambda_handler,
+        host=args.host,
+        port=args.port,
+        event_format=args.event_format,
+        processes=args.processes,
+    )
+
+
+if __name__ == "__main__":
+    main()
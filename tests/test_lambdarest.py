@@ -3,15 +3,46 @@ try:
 except ImportError:
     import mock
 
+import asyncio
 import copy
 import json
 import random
 import time
 import unittest
 import base64
+import threading
+from concurrent.futures import Future
 from datetime import datetime
+from http.client import HTTPConnection
 
-from lambdarest import create_lambda_handler, Response, CORS
+from werkzeug.exceptions import NotFound
+from werkzeug.routing import Map
+from werkzeug.serving import make_server
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Response as WerkzeugResponse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+from lambdarest import (
+    create_lambda_handler,
+    Request,
+    Response,
+    StreamingResponse,
+    Blueprint,
+    CORS,
+    AccessLog,
+    check_update_and_fill_resource_placeholders,
+)
+from lambdarest.testing import TestClient, simulate_snapshot_restore
+from lambdarest.wsgi import ASGIAdapter, WSGIAdapter
 
 
 def assert_not_called(mock):
@@ -1045,3 +1076,1588 @@ class TestLambdarestFunctions(unittest.TestCase):
         self.lambda_handler.handle("post")(post_mock)
         result = self.lambda_handler(self.event, self.context)
         self.assertEqual(True, result["headers"]["Access-Control-Allow-Credentials"])
+
+    def test_batch_records_are_dispatched_by_event_source(self):
+        sqs_mock = mock.Mock(side_effect=[None, ValueError("boom")])
+        kinesis_mock = mock.Mock()
+        self.lambda_handler.handle_record("aws:sqs")(sqs_mock)
+        self.lambda_handler.handle_record("aws:kinesis")(kinesis_mock)
+
+        event = {
+            "Records": [
+                {"eventSource": "aws:sqs", "messageId": "1", "body": "a"},
+                {"eventSource": "aws:kinesis", "kinesis": {"sequenceNumber": "2"}},
+            ]
+        }
+        result = self.lambda_handler(event, self.context)
+        self.assertEqual(result, {"batchItemFailures": []})
+        assert_called_once(kinesis_mock)
+
+        event["Records"] = [{"eventSource": "aws:sqs", "messageId": "3"}]
+        result = self.lambda_handler(event, self.context)
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "3"}]})
+
+    def test_batch_records_are_matched_on_attributes(self):
+        created_mock = mock.Mock()
+        deleted_mock = mock.Mock()
+        self.lambda_handler.handle_record("aws:sqs", attributes={"type": "created"})(
+            created_mock
+        )
+        self.lambda_handler.handle_record("aws:dynamodb", {"eventName": "REMOVE"})(
+            deleted_mock
+        )
+
+        records = [
+            {
+                "eventSource": "aws:sqs",
+                "messageId": str(i),
+                "messageAttributes": {"type": {"stringValue": "created"}},
+            }
+            for i in range(20)
+        ]
+        records.append(
+            {
+                "eventSource": "aws:dynamodb",
+                "eventName": "REMOVE",
+                "dynamodb": {"SequenceNumber": "100"},
+            }
+        )
+        records.append(
+            {
+                "eventSource": "aws:dynamodb",
+                "eventName": "INSERT",
+                "dynamodb": {"SequenceNumber": "101"},
+            }
+        )
+        result = self.lambda_handler.handle_batch({"Records": records})
+        self.assertEqual(result, {"batchItemFailures": [{"itemIdentifier": "101"}]})
+        self.assertEqual(created_mock.call_count, 20)
+        assert_called_once(deleted_mock)
+
+    def test_ordered_batch_records_stop_at_the_first_failure_of_a_group(self):
+        processed = []
+
+        def process(record):
+            processed.append(record.get("kinesis", record)["sequenceNumber"])
+            if record.get("data") == "broken":
+                raise ValueError("broken")
+
+        self.lambda_handler.handle_record()(process)
+
+        def kinesis(sequence_number, partition_key, data="ok"):
+            return {
+                "eventSource": "aws:kinesis",
+                "data": data,
+                "kinesis": {
+                    "sequenceNumber": sequence_number,
+                    "partitionKey": partition_key,
+                },
+            }
+
+        records = [
+            kinesis("1", "a"),
+            kinesis("2", "b"),
+            kinesis("3", "a", "broken"),
+            kinesis("4", "b"),
+            kinesis("5", "a"),
+            kinesis("6", "a"),
+        ]
+        with mock.patch("logging.error"):
+            result = self.lambda_handler({"Records": records}, self.context)
+        self.assertEqual(
+            result,
+            {
+                "batchItemFailures": [
+                    {"itemIdentifier": "3"},
+                    {"itemIdentifier": "5"},
+                    {"itemIdentifier": "6"},
+                ]
+            },
+        )
+        self.assertEqual(sorted(processed), ["1", "2", "3", "4"])
+
+        # FIFO queues keep their order per message group
+        processed[:] = []
+        records = [
+            {
+                "eventSource": "aws:sqs",
+                "messageId": str(i),
+                "sequenceNumber": str(i),
+                "data": "broken" if i == 0 else "ok",
+                "attributes": {"MessageGroupId": "g%s" % (i % 2)},
+            }
+            for i in range(4)
+        ]
+        with mock.patch("logging.error"):
+            result = self.lambda_handler({"Records": records}, self.context)
+        self.assertEqual(
+            result,
+            {"batchItemFailures": [{"itemIdentifier": "0"}, {"itemIdentifier": "2"}]},
+        )
+        self.assertEqual(sorted(processed), ["0", "1", "3"])
+
+    def test_failing_batch_records_are_logged_rate_limited(self):
+        with mock.patch("lambdarest.time.monotonic", return_value=1000.0):
+            lambda_handler = create_lambda_handler(error_log_rate=2)
+            lambda_handler.handle_record("aws:sqs")(mock.Mock(side_effect=KeyError))
+            event = {
+                "Records": [
+                    {"eventSource": "aws:sqs", "messageId": str(i)} for i in range(5)
+                ]
+            }
+            with mock.patch("logging.exception") as exception_mock:
+                result = lambda_handler(event, self.context)
+        self.assertEqual(len(result["batchItemFailures"]), 5)
+        self.assertEqual(exception_mock.call_count, 2)
+        self.assertEqual(
+            lambda_handler.metrics["errors"],
+            {"handled": 0, "logged": 2, "suppressed": 3},
+        )
+
+    def test_unmatched_batch_records_can_be_skipped(self):
+        event = {"Records": [{"eventSource": "aws:sns", "messageId": "1"}]}
+        for unmatched_records, failures in (
+            ("fail", [{"itemIdentifier": "1"}]),
+            ("skip", []),
+        ):
+            lambda_handler = create_lambda_handler(unmatched_records=unmatched_records)
+            lambda_handler.handle_record("aws:sqs")(mock.Mock())
+            with mock.patch("logging.warning") as warning_mock:
+                result = lambda_handler(event, self.context)
+            self.assertEqual(result, {"batchItemFailures": failures})
+            assert_called_once(warning_mock)
+        with self.assertRaises(ValueError):
+            create_lambda_handler(unmatched_records="retry")
+
+    def test_map_runs_tasks_in_parallel_and_records_timings(self):
+        def slow_double(value):
+            time.sleep(0.05)
+            return value * 2
+
+        def post_handler(event):
+            return {"doubled": self.lambda_handler.map(slow_double, [1, 2, 3, 4])}
+
+        self.lambda_handler.handle("post")(post_handler)
+        start = time.monotonic()
+        result = self.lambda_handler(self.event, self.context)
+        self.assertLess(time.monotonic() - start, 0.15)
+        self.assertEqual(result["body"], '{"doubled": [2, 4, 6, 8]}')
+        self.assertEqual(
+            self.lambda_handler.metrics["tasks"]["slow_double"]["count"], 4
+        )
+
+    def test_map_respects_invocation_deadline_and_cancels_leftovers(self):
+        context = mock.Mock()
+        context.get_remaining_time_in_millis.return_value = 150
+
+        def post_handler(event):
+            return self.lambda_handler.map(time.sleep, [0.5] * 20)
+
+        self.lambda_handler.handle("post")(post_handler)
+        with mock.patch("logging.warning") as warning_mock:
+            result = self.lambda_handler(self.event, context)
+        self.assertEqual(result["statusCode"], 500)
+        assert_called_once(warning_mock)
+
+    def test_tasks_of_record_handlers_run_inline_on_the_pool(self):
+        lambda_handler = create_lambda_handler(max_workers=2)
+
+        @lambda_handler.handle_record("aws:sqs")
+        def fan_out(record):
+            # every pool thread waits for these, queueing them would deadlock
+            return lambda_handler.map(len, [record["body"]] * 3)
+
+        event = {
+            "Records": [
+                {"eventSource": "aws:sqs", "messageId": str(i), "body": "abc"}
+                for i in range(4)
+            ]
+        }
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(lambda_handler(event, self.context)),
+            daemon=True,
+        )
+        thread.start()
+        thread.join(5)
+        self.assertEqual(results, [{"batchItemFailures": []}])
+        self.assertEqual(lambda_handler.metrics["tasks"]["len"]["count"], 12)
+
+    def test_warmup_ping_is_acknowledged_and_primes(self):
+        prime_mock = mock.Mock(__name__="prime_mock")
+        post_mock = mock.Mock(return_value="foo")
+        self.lambda_handler.prime(prime_mock)
+        self.lambda_handler.handle("post")(post_mock)
+
+        for event in (
+            {"warmer": True},
+            {"source": "aws.events", "detail-type": "Scheduled Event"},
+        ):
+            with mock.patch("logging.error") as error_mock:
+                result = self.lambda_handler(event, self.context)
+            self.assertEqual(result, {"warmed": True})
+            assert_not_called(error_mock)
+
+        # primed once per container, and again after a restore
+        assert_called_once(prime_mock)
+        assert_not_called(post_mock)
+        simulate_snapshot_restore(self.lambda_handler)
+        self.lambda_handler({"warmer": True}, self.context)
+        self.assertEqual(prime_mock.call_count, 2)
+
+        lambda_handler = create_lambda_handler(prime_on_warmup="always")
+        lambda_handler.prime(prime_mock)
+        for _ in range(3):
+            lambda_handler({"warmer": True}, self.context)
+        self.assertEqual(prime_mock.call_count, 5)
+        with self.assertRaises(ValueError):
+            create_lambda_handler(prime_on_warmup="once")
+
+    def test_warmup_ping_without_priming(self):
+        lambda_handler = create_lambda_handler(prime_on_warmup=False)
+        prime_mock = mock.Mock()
+        lambda_handler.prime(prime_mock)
+        self.assertEqual(lambda_handler({"warmer": True}), {"warmed": True})
+        assert_not_called(prime_mock)
+
+    def test_snapshot_restore_hooks_run_in_order(self):
+        calls = []
+        self.lambda_handler.before_snapshot(lambda: calls.append("snapshot"))
+        self.lambda_handler.after_restore(lambda: calls.append("restore"))
+        self.lambda_handler.handle("post")(mock.Mock(return_value="foo"))
+
+        # create the thread pool, it must not be part of the snapshot
+        self.lambda_handler.submit(len, []).result()
+        simulate_snapshot_restore(self.lambda_handler)
+        self.assertEqual(calls, ["snapshot", "restore"])
+
+        self.assertEqual(self.lambda_handler.submit(len, [1]).result(), 1)
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "foo")
+
+    def test_cors_preflight_is_answered_from_the_url_map(self):
+        CORS(self.lambda_handler, max_age=600)
+        post_mock = mock.Mock(return_value="foo")
+        self.lambda_handler.handle("post")(post_mock)
+        self.lambda_handler.handle("put")(post_mock)
+
+        self.event["httpMethod"] = "OPTIONS"
+        self.event["body"] = "{invalid json"
+        self.event["headers"] = {"Access-Control-Request-Headers": "X-Custom"}
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(
+            result,
+            {
+                "statusCode": 204,
+                "headers": {
+                    "Access-Control-Allow-Origin": "*",
+                    "Access-Control-Allow-Methods": "POST, OPTIONS, PUT",
+                    "Access-Control-Allow-Headers": "X-Custom",
+                    "Access-Control-Max-Age": 600,
+                },
+            },
+        )
+        assert_not_called(post_mock)
+
+        self.event["resource"] = "/unknown"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 404)
+
+    def test_cors_origin_allow_list(self):
+        CORS(self.lambda_handler, origin=["https://a.example", "https://b.example"])
+        self.lambda_handler.handle("post")(mock.Mock(return_value="foo"))
+
+        self.event["headers"] = {"origin": "https://b.example"}
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(
+            "https://b.example", result["headers"]["Access-Control-Allow-Origin"]
+        )
+        self.assertEqual("Origin", result["headers"]["Vary"])
+
+        # responses to other origins must not be cached for allowed ones
+        for headers in ({"Origin": "https://evil.example"}, None):
+            self.event["headers"] = headers
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(result["headers"], {"Vary": "Origin"})
+
+        self.event["httpMethod"] = "OPTIONS"
+        self.event["headers"] = {"Origin": "https://evil.example"}
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 204)
+        self.assertEqual(result["headers"], {"Vary": "Origin"})
+        self.event["headers"] = {"Origin": "https://a.example"}
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["headers"]["Vary"], "Origin")
+        self.assertEqual(
+            result["headers"]["Access-Control-Allow-Origin"], "https://a.example"
+        )
+
+    def test_method_not_allowed_returns_405(self):
+        self.lambda_handler.handle("get")(mock.Mock(return_value="foo"))
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 405)
+
+    def test_scopes_wildcards_and_any_mode(self):
+        self.lambda_handler.handle(
+            "post",
+            path="/all",
+            scopes=["orders.read", "orders.items.write"],
+            scopes_wildcards=True,
+        )(mock.Mock(return_value="all"))
+        self.lambda_handler.handle(
+            "post", path="/any", scopes=["admin", "orders.read"], scopes_mode="any"
+        )(mock.Mock(return_value="any"))
+        self.lambda_handler.handle(
+            "post",
+            path="/colons",
+            scopes=["orders:read"],
+            scopes_wildcards=True,
+            scopes_separator=":",
+        )(mock.Mock(return_value="colons"))
+
+        def call(resource, scopes):
+            self.event["resource"] = resource
+            self.event["requestContext"]["authorizer"] = {"scopes": json.dumps(scopes)}
+            return self.lambda_handler(self.event, self.context)["statusCode"]
+
+        self.assertEqual(call("/all", ["orders.read", "orders.items.write"]), 200)
+        self.assertEqual(call("/all", ["orders.*"]), 200)
+        self.assertEqual(call("/all", ["*"]), 200)
+        self.assertEqual(call("/all", ["orders.read", "orders.items.read"]), 403)
+        self.assertEqual(call("/any", ["orders.read"]), 200)
+        self.assertEqual(call("/any", ["users.read"]), 403)
+        # wildcards are literal scopes unless enabled
+        self.assertEqual(call("/any", ["*"]), 403)
+        self.assertEqual(call("/any", ["orders.*"]), 403)
+        self.assertEqual(call("/colons", ["orders:*"]), 200)
+        self.assertEqual(call("/colons", ["orders.*"]), 403)
+
+        with self.assertRaises(ValueError):
+            self.lambda_handler.handle("post", scopes=["a"], scopes_mode="some")
+
+    def test_scopes_parsing_is_memoized(self):
+        self.lambda_handler.handle("post", scopes=["resource1.method2"])(
+            mock.Mock(return_value="foo")
+        )
+        self.event["requestContext"]["authorizer"] = {
+            "scopes": '["resource1.method2", "x.y"]'
+        }
+        with mock.patch("json.loads", wraps=json.loads) as loads_mock:
+            for _ in range(3):
+                result = self.lambda_handler(self.event, self.context)
+                self.assertEqual(result["statusCode"], 200)
+        # three bodies and the scopes of the first request only
+        self.assertEqual(loads_mock.call_count, 4)
+
+    def test_request_object_does_not_mutate_event(self):
+        def get_handler(request, id):
+            return {
+                "id": id,
+                "path_params": request.path_params,
+                "rule": request.rule.rule,
+                "context": request.context,
+                "content_type": request.headers.get("content-type"),
+                "session": request.cookies.get("session"),
+                "page": request.query.get("page"),
+                "body": request.json["body"],
+            }
+
+        self.lambda_handler.handle("post", path="/items/<id>", request=True)(
+            get_handler
+        )
+        self.event["resource"] = "/items/{id}"
+        self.event["path"] = "/items/42"
+        self.event["pathParameters"] = {"id": "42"}
+        self.event["headers"] = {
+            "Content-Type": "application/json",
+            "Cookie": "session=abc",
+        }
+        self.event["queryStringParameters"] = {"page": "2"}
+        self.event["body"] = '{"name": "thing"}'
+        original_event = copy.deepcopy(self.event)
+
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(
+            json.loads(result["body"]),
+            {
+                "id": "42",
+                "path_params": {"id": "42"},
+                "rule": "/items/<id>",
+                "context": {"foo": "bar"},
+                "content_type": "application/json",
+                "session": "abc",
+                "page": "2",
+                "body": {"name": "thing"},
+            },
+        )
+        self.assertEqual(self.event, original_event)
+
+    def test_request_object_parses_bodies_of_load_json_false_routes(self):
+        @self.lambda_handler.handle("post", load_json=False, request=True)
+        def post_handler(request):
+            return {"json": request.json["body"], "form": request.form.to_dict()}
+
+        for content_type, body, expected in (
+            ("application/json", '{"a": 1}', {"json": {"a": 1}, "form": {}}),
+            (
+                "application/x-www-form-urlencoded",
+                "a=1&b=x",
+                {"json": {"a": "1", "b": "x"}, "form": {"a": "1", "b": "x"}},
+            ),
+        ):
+            self.event["headers"] = {"Content-Type": content_type}
+            self.event["body"] = body
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(json.loads(result["body"]), expected)
+
+        self.event["headers"] = {"Content-Type": "application/json"}
+        self.event["body"] = "{not json"
+        with mock.patch("logging.warning"):
+            result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(result["body"], "Invalid json body")
+
+    def test_request_object_has_slots(self):
+        request = Request({"httpMethod": "GET", "resource": "/"})
+        with self.assertRaises(AttributeError):
+            request.foo = "bar"
+        self.assertIs(request.headers, request.headers)
+        self.assertEqual(request.json, {"body": {}, "query": {}})
+
+    def test_tuple_fast_path_matches_response_to_json(self):
+        for alb in (False, True):
+            for returned in [({"a": 1}, 201), ("text", None), (None, 204)]:
+                handler = create_lambda_handler(application_load_balancer=alb)
+                handler.handle("post")(mock.Mock(return_value=returned))
+                self.assertEqual(
+                    handler(dict(self.event), self.context),
+                    Response(*returned).to_json(application_load_balancer=alb),
+                )
+
+    def test_response_has_slots(self):
+        with self.assertRaises(AttributeError):
+            Response("foo").foo = "bar"
+
+    def test_response_schema_serializer_matches_json_dumps(self):
+        response_schema = {
+            "type": "object",
+            "properties": {
+                "id": {"type": "integer"},
+                "price": {"type": "number"},
+                "name": {"type": "string"},
+                "active": {"type": "boolean"},
+                "tags": {"type": "array", "items": {"type": "string"}},
+                "owner": {
+                    "type": "object",
+                    "properties": {"name": {"type": "string"}},
+                },
+            },
+        }
+        bodies = [
+            {
+                "id": 1,
+                "price": 9.5,
+                "name": 'tæst "quoted"',
+                "active": True,
+                "tags": ["a", "b"],
+                "owner": {"name": "ann"},
+            },
+            {"id": "not an int", "price": float("nan"), "tags": [1, None]},
+            {"name": "extra", "unknown": {"b": 1, "a": 2}},
+            {"owner": None, "price": 3},
+        ]
+        for body in bodies:
+            handler = create_lambda_handler()
+            handler.handle("post", response_schema=response_schema)(
+                mock.Mock(return_value=(body, 200))
+            )
+            result = handler(dict(self.event), self.context)
+            self.assertEqual(result["body"], json.dumps(body, sort_keys=True))
+
+    def test_response_schema_sampled_validation_only_logs(self):
+        lambda_handler = create_lambda_handler(response_validation_rate=1.0)
+        response_schema = {"type": "object", "required": ["id"]}
+        lambda_handler.handle("post", response_schema=response_schema)(
+            mock.Mock(return_value={"name": "no id"})
+        )
+        with mock.patch("logging.warning") as warning_mock:
+            result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+        assert_called_once(warning_mock)
+        self.assertEqual(
+            lambda_handler.metrics["response_validation"],
+            {"sampled": 1, "violations": 1},
+        )
+
+        lambda_handler.handle(
+            "get", response_schema=response_schema, response_validation_rate=0
+        )(mock.Mock(return_value={"name": "no id"}))
+        self.event["httpMethod"] = "GET"
+        lambda_handler(self.event, self.context)
+        self.assertEqual(lambda_handler.metrics["response_validation"]["sampled"], 1)
+
+    def test_structural_validation_only_checks_required_keys(self):
+        post_schema = {
+            "type": "object",
+            "properties": {
+                "body": {
+                    "type": "object",
+                    "required": ["name"],
+                    "properties": {"name": {"type": "string"}},
+                }
+            },
+        }
+        self.lambda_handler.handle("post", schema=post_schema, validation="structural")(
+            mock.Mock(return_value="foo")
+        )
+
+        self.event["body"] = json.dumps({"name": 1})
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+
+        for body in ({"other": "x"}, ["not", "an", "object"]):
+            self.event["body"] = json.dumps(body)
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(
+                result, {"body": "Validation Error", "statusCode": 400, "headers": {}}
+            )
+
+    def test_sampled_validation(self):
+        post_schema = {
+            "type": "object",
+            "properties": {"body": {"type": "object", "required": ["name"]}},
+        }
+        lambda_handler = create_lambda_handler(validation="sampled")
+        lambda_handler.handle("post", schema=post_schema, validation_sample_rate=0)(
+            mock.Mock(return_value="foo")
+        )
+        lambda_handler.handle("put", schema=post_schema, validation_sample_rate=1.0)(
+            mock.Mock(return_value="foo")
+        )
+
+        self.event["body"] = "{}"
+        result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+        self.event["httpMethod"] = "PUT"
+        result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 400)
+
+        with self.assertRaises(ValueError):
+            lambda_handler.handle("post", schema=post_schema, validation="never")
+
+    def test_max_body_bytes_rejects_before_decoding(self):
+        lambda_handler = create_lambda_handler(max_body_bytes=100)
+        post_mock = mock.Mock(return_value="foo")
+        lambda_handler.handle("post")(post_mock)
+        lambda_handler.handle("put", max_body_bytes=1000)(post_mock)
+
+        self.event["body"] = json.dumps({"data": "x" * 200})
+        with mock.patch("json.loads") as loads_mock:
+            result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 413)
+        assert_not_called(loads_mock)
+        assert_not_called(post_mock)
+
+        self.event["httpMethod"] = "PUT"
+        result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+
+    def test_base64_json_body_is_decoded(self):
+        post_mock = mock.Mock(return_value="foo")
+        self.lambda_handler.handle("post")(post_mock)
+        self.event["body"] = base64.b64encode(b'{"foo": "bar"}').decode()
+        self.event["isBase64Encoded"] = True
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(post_mock.call_args[0][0]["json"]["body"], {"foo": "bar"})
+
+        self.event["body"] = "not base64!"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "Invalid base64 body")
+
+    def test_binary_body_is_decoded_once_and_shared(self):
+        png = b"\x89PNG\r\n\x1a\n" + bytes(range(256))
+        self.event["body"] = base64.b64encode(png).decode()
+        self.event["isBase64Encoded"] = True
+
+        def upload(event):
+            return {
+                "size": len(event["raw_body"]),
+                "magic": bytes(event["raw_body"][1:4]).decode(),
+            }
+
+        def upload_request(request):
+            self.assertIs(request.body_view.obj, request.data)
+            return {
+                "size": len(request.body_view),
+                "magic": bytes(request.body_view[1:4]).decode(),
+            }
+
+        self.lambda_handler.handle("post", path="/event", load_json=False)(upload)
+        self.lambda_handler.handle(
+            "post", path="/request", load_json=False, request=True
+        )(upload_request)
+
+        with mock.patch("base64.b64decode", wraps=base64.b64decode) as decode_mock:
+            for resource in ("/event", "/request"):
+                self.event["resource"] = resource
+                result = self.lambda_handler(self.event, self.context)
+                self.assertEqual(
+                    json.loads(result["body"]), {"size": 264, "magic": "PNG"}
+                )
+        self.assertEqual(decode_mock.call_count, 2)
+
+    def test_form_urlencoded_body_is_parsed_and_validated(self):
+        post_schema = {
+            "type": "object",
+            "properties": {
+                "body": {
+                    "type": "object",
+                    "required": ["name"],
+                    "properties": {
+                        "name": {"type": "string"},
+                        "age": {"type": "integer"},
+                        "tags": {"type": "array", "items": {"type": "string"}},
+                    },
+                }
+            },
+        }
+        post_mock = mock.Mock(return_value="foo")
+        self.lambda_handler.handle("post", schema=post_schema)(post_mock)
+
+        self.event["headers"] = {
+            "Content-Type": "application/x-www-form-urlencoded; charset=utf-8"
+        }
+        self.event["body"] = "name=ann&age=42&tags=a&tags=b"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 200)
+        self.assertEqual(
+            post_mock.call_args[0][0]["json"]["body"],
+            {"name": "ann", "age": 42, "tags": ["a", "b"]},
+        )
+
+        self.event["body"] = "age=42"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "Validation Error")
+
+    def test_multipart_body_is_spooled_and_capped(self):
+        lambda_handler = create_lambda_handler(
+            max_part_bytes=4096, spool_threshold=1024
+        )
+        uploads = {}
+
+        def upload(request):
+            upload = request.files["file"]
+            uploads["rolled"] = upload.stream._rolled
+            return {"title": request.json["body"]["title"], "size": len(upload.read())}
+
+        lambda_handler.handle("post", request=True)(upload)
+
+        def multipart(file_content):
+            body = (
+                b"--XX\r\n"
+                b'Content-Disposition: form-data; name="title"\r\n\r\n'
+                b"holiday\r\n"
+                b"--XX\r\n"
+                b'Content-Disposition: form-data; name="file"; filename="a.bin"\r\n'
+                b"Content-Type: application/octet-stream\r\n\r\n"
+                + file_content
+                + b"\r\n--XX--\r\n"
+            )
+            self.event["headers"] = {"content-type": "multipart/form-data; boundary=XX"}
+            self.event["body"] = base64.b64encode(body).decode()
+            self.event["isBase64Encoded"] = True
+            return lambda_handler(self.event, self.context)
+
+        result = multipart(b"\x00" * 2000)
+        self.assertEqual(json.loads(result["body"]), {"title": "holiday", "size": 2000})
+        self.assertTrue(uploads["rolled"])
+
+        result = multipart(b"\x00" * 5000)
+        self.assertEqual(result["statusCode"], 413)
+
+    @unittest.skipIf(msgpack is None, "msgpack is not installed")
+    def test_msgpack_content_negotiation(self):
+        post_schema = {
+            "type": "object",
+            "properties": {
+                "body": {"type": "object", "properties": {"n": {"type": "integer"}}}
+            },
+        }
+        self.lambda_handler.handle("post", schema=post_schema)(
+            lambda event: ({"doubled": event["json"]["body"]["n"] * 2}, 201)
+        )
+        self.event["headers"] = {
+            "Content-Type": "application/msgpack",
+            "Accept": "application/json;q=0.5, application/msgpack",
+        }
+        self.event["body"] = base64.b64encode(msgpack.packb({"n": 21})).decode()
+        self.event["isBase64Encoded"] = True
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 201)
+        self.assertTrue(result["isBase64Encoded"])
+        self.assertEqual(result["headers"], {"Content-Type": "application/msgpack"})
+        self.assertEqual(
+            msgpack.unpackb(base64.b64decode(result["body"])), {"doubled": 42}
+        )
+
+        self.event["body"] = base64.b64encode(msgpack.packb({"n": "x"})).decode()
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "Validation Error")
+
+        self.event["headers"]["Accept"] = "*/*"
+        self.event["body"] = base64.b64encode(msgpack.packb({"n": 1})).decode()
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], '{"doubled": 2}')
+
+    @unittest.skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_cbor_response_for_alb(self):
+        self.lambda_handler_application_load_balancer.handle("post")(
+            mock.Mock(return_value=Response([1.5, 2.5], headers={"X-Foo": "bar"}))
+        )
+        self.event["headers"] = {"accept": "application/cbor"}
+        result = self.lambda_handler_application_load_balancer(self.event, self.context)
+        self.assertEqual(
+            result["headers"], {"X-Foo": "bar", "Content-Type": "application/cbor"}
+        )
+        self.assertTrue(result["isBase64Encoded"])
+        self.assertEqual(cbor2.loads(base64.b64decode(result["body"])), [1.5, 2.5])
+
+    def test_streaming_response_encodes_iterators(self):
+        consumed = []
+
+        def items():
+            for n in range(3):
+                consumed.append(n)
+                yield {"n": n, "tags": ["a"]}
+
+        self.lambda_handler.handle("get", path="/items")(
+            lambda event: StreamingResponse(items(), headers={"X-Foo": "bar"})
+        )
+        self.lambda_handler.handle("get", path="/lines")(
+            lambda event: StreamingResponse(iter([1, "two"]), format="ndjson")
+        )
+        self.lambda_handler.handle("get", path="/empty")(
+            lambda event: StreamingResponse(iter([]), format="ndjson")
+        )
+        self.event["httpMethod"] = "GET"
+
+        self.event["resource"] = "/items"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(
+            result,
+            {
+                "body": '[{"n": 0, "tags": ["a"]}, {"n": 1, "tags": ["a"]}, '
+                '{"n": 2, "tags": ["a"]}]',
+                "statusCode": 200,
+                "headers": {"X-Foo": "bar", "Content-Type": "application/json"},
+            },
+        )
+        self.assertEqual(json.loads(result["body"])[2]["n"], 2)
+        self.assertEqual(consumed, [0, 1, 2])
+
+        self.event["resource"] = "/lines"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], '1\n"two"\n')
+        self.assertEqual(result["headers"], {"Content-Type": "application/x-ndjson"})
+
+        self.event["resource"] = "/empty"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "")
+
+    def test_streaming_response_truncates_near_max_bytes(self):
+        consumed = []
+
+        def items():
+            for n in range(1000):
+                consumed.append(n)
+                yield n
+
+        response = StreamingResponse(
+            items(), max_bytes=10, next_page=lambda sent: "/items?offset=%s" % sent
+        )
+        result = response.to_json()
+        self.assertEqual(result["statusCode"], 206)
+        self.assertEqual(result["body"], "[0, 1, 2]")
+        self.assertEqual(result["headers"]["Content-Range"], "items 0-2/*")
+        self.assertEqual(result["headers"]["Link"], '</items?offset=3>; rel="next"')
+        # stops pulling from the iterator once the cap is reached
+        self.assertEqual(consumed, [0, 1, 2, 3])
+
+        result = StreamingResponse(iter(["x" * 20]), max_bytes=10).to_json()
+        self.assertEqual(result["body"], "[]")
+        self.assertEqual(result["headers"]["Content-Range"], "items */*")
+
+    def test_blueprints_dispatch_on_prefix_and_compile_lazily(self):
+        calls = []
+        users = Blueprint("users")
+        users.before_request(lambda: calls.append("before"))
+        users.after_request(
+            lambda response: calls.append("after")
+            or Response(response.body, response.status_code, {"X-Bp": "users"})
+        )
+
+        @users.handle("get")
+        def list_users(event):
+            return ["alice"]
+
+        @users.handle(
+            "post",
+            path="/<int:user_id>",
+            schema={
+                "type": "object",
+                "properties": {"body": {"type": "object", "required": ["name"]}},
+            },
+        )
+        def update_user(event, user_id):
+            return {"id": user_id, "name": event["json"]["body"]["name"]}
+
+        self.lambda_handler.handle("get", path="/health")(lambda event: "ok")
+        self.lambda_handler.mount(users, "/users")
+
+        with mock.patch("lambdarest.Map", wraps=Map) as map_mock:
+            self.event["httpMethod"] = "GET"
+            self.event["resource"] = "/health"
+            self.assertEqual(
+                self.lambda_handler(self.event, self.context)["body"], "ok"
+            )
+            self.assertEqual(calls, [])
+            map_mock.assert_not_called()
+
+            self.event["resource"] = "/users"
+            result = self.lambda_handler(self.event, self.context)
+            self.lambda_handler(self.event, self.context)
+            map_mock.assert_called_once_with()
+        self.assertEqual(result["body"], '["alice"]')
+        self.assertEqual(result["headers"], {"X-Bp": "users"})
+        self.assertEqual(calls, ["before", "after"] * 2)
+
+        self.event["httpMethod"] = "POST"
+        self.event["resource"] = "/users/3"
+        self.event["body"] = json.dumps({"name": "bob"})
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(json.loads(result["body"]), {"id": 3, "name": "bob"})
+
+        self.event["body"] = json.dumps({})
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 400)
+        self.assertEqual(result["headers"], {"X-Bp": "users"})
+
+        self.event["resource"] = "/users/3/extra"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 404)
+
+    def test_mount_rejects_invalid_prefixes(self):
+        blueprint = Blueprint()
+        self.lambda_handler.mount(blueprint, "/things/")
+        for prefix in ("things", "/", "/a/b", "/<name>", "/things"):
+            with self.assertRaises(ValueError):
+                self.lambda_handler.mount(blueprint, prefix)
+        with self.assertRaises(ValueError):
+            blueprint.handle("get", path="relative")
+        for options in (
+            {"schema": {"type": "object"}, "load_json": False},
+            {"rate_limit": 0},
+            {"validation": "never"},
+            {"scopes": ["a"], "scopes_mode": "some"},
+        ):
+            with self.assertRaises(ValueError):
+                blueprint.handle("get", **options)
+        self.assertEqual(blueprint.routes, [])
+
+    def test_blueprint_routes_added_later_and_catch_all(self):
+        things = Blueprint("things")
+        things.handle("get", path="/a")(lambda event: "a")
+        self.lambda_handler.mount(things, "/things")
+        self.event["httpMethod"] = "GET"
+
+        def call(resource):
+            self.event["resource"] = resource
+            return self.lambda_handler(self.event, self.context)
+
+        self.assertEqual(call("/things/a")["body"], "a")
+        self.assertEqual(call("/things/b")["statusCode"], 404)
+
+        things.handle("get", path="/b")(lambda event: "b")
+        self.assertEqual(call("/things/b")["body"], "b")
+
+        things.handle("get", path="*")(lambda event: "any")
+        result = call("/things/c/d")
+        self.assertEqual((result["statusCode"], result["body"]), (200, "any"))
+        self.assertEqual(call("/things/a")["body"], "a")
+
+    def test_route_cache_hits_and_invalidation(self):
+        self.lambda_handler.handle("get", path="/items/<int:item_id>", request=True)(
+            lambda request, item_id: request.path_params.pop("item_id")
+        )
+        self.event["httpMethod"] = "GET"
+        self.event["resource"] = "/items/5"
+        for _ in range(3):
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(result["body"], "5")
+        info = self.lambda_handler.route_cache_info()
+        self.assertEqual((info.hits, info.misses, info.maxsize), (2, 1, 1024))
+
+        # negative results are cached and forgotten when routes are added
+        self.event["resource"] = "/other"
+        for _ in range(2):
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(result["statusCode"], 404)
+        self.assertEqual(self.lambda_handler.route_cache_info().hits, 3)
+
+        self.lambda_handler.handle("get", path="/other")(lambda event: "found")
+        self.assertEqual(self.lambda_handler.route_cache_info().currsize, 0)
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "found")
+
+    def test_route_cache_can_be_disabled(self):
+        lambda_handler = create_lambda_handler(route_cache_size=0)
+        lambda_handler.handle("get", path="/")(lambda event: "ok")
+        self.event["httpMethod"] = "GET"
+        for _ in range(2):
+            self.assertEqual(lambda_handler(self.event, self.context)["body"], "ok")
+        info = lambda_handler.route_cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (0, 2, 0))
+
+    def test_fill_resource_placeholders(self):
+        fill = check_update_and_fill_resource_placeholders
+        cases = [
+            ("/foo/{key1}/bar/{key2}", {"key1": "a", "key2": 2}, "/foo/a/bar/2"),
+            ("/foo/{key1}/bar/{key2}", {"key1": "a"}, "/foo/a/bar/{key2}"),
+            ("/foo/{key1}/{proxy+}", {"key1": "a", "proxy": "x/y"}, "/foo/a/{proxy+}"),
+            ("/foo/{key1}", {}, "/foo/{key1}"),
+            ("/foo/{key1}", None, "/foo/{key1}"),
+            ("/foo/bar", {"key1": "a"}, "/foo/bar"),
+            ("/foo/${key1}/{key1}", {"key1": "a"}, "/foo/${key1}/a"),
+            ("/foo/$other/{key1}", {"key1": "a"}, "/foo/$other/{key1}"),
+        ]
+        for resource, path_parameters, expected in cases:
+            self.assertEqual(fill(resource, path_parameters), expected)
+
+        with mock.patch("lambdarest.re.compile") as compile_mock:
+            fill("/foo/{key1}/bar/{key2}", {"key1": "b", "key2": "c"})
+        compile_mock.assert_not_called()
+
+    def test_known_base_path_is_stripped(self):
+        lambda_handler = create_lambda_handler(base_path="v2/")
+        lambda_handler.handle("get", path="/")(lambda event: "root")
+        lambda_handler.handle("get", path="/v2/<name>")(lambda event, name: name)
+        lambda_handler.handle("get", path="/things/<name>")(lambda event, name: name)
+        self.event["httpMethod"] = "GET"
+
+        for path, resource, expected in [
+            ("/v2/things/foo", "/things/{name}", "foo"),
+            ("/v2", "/", "root"),
+            ("/things/bar", "/things/{name}", "bar"),
+            # not the base path, only a prefix of the first segment
+            ("/v2x", "/v2/{name}", "v2x"),
+        ]:
+            self.event["path"] = path
+            self.event["resource"] = resource
+            self.event["pathParameters"] = {"name": path.rsplit("/", 1)[1]}
+            result = lambda_handler(self.event, self.context)
+            self.assertEqual(result["body"], expected)
+
+    def test_errorhandler_resolves_exception_mro(self):
+        class DomainError(Exception):
+            pass
+
+        class NotAllowed(DomainError):
+            pass
+
+        handled = []
+
+        @self.lambda_handler.errorhandler(DomainError)
+        def domain_error(error):
+            handled.append(type(error))
+            return {"error": str(error)}, 409
+
+        self.lambda_handler.errorhandler(NotFound)(lambda error: ("nothing here", 404))
+        self.lambda_handler.after_request(
+            lambda response: Response(
+                response.body, response.status_code, {"X-After": "yes"}
+            )
+        )
+
+        def raise_error(event):
+            raise NotAllowed("no way")
+
+        self.lambda_handler.handle("post")(raise_error)
+        for _ in range(2):
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(
+                result,
+                {
+                    "body": '{"error": "no way"}',
+                    "statusCode": 409,
+                    "headers": {"X-After": "yes"},
+                },
+            )
+        self.assertEqual(handled, [NotAllowed, NotAllowed])
+
+        self.event["resource"] = "/missing"
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["body"], "nothing here")
+        self.assertEqual(self.lambda_handler.metrics["errors"]["handled"], 3)
+
+        with self.assertRaises(ValueError):
+            self.lambda_handler.errorhandler("DomainError")
+
+    def test_default_error_logging_is_rate_limited(self):
+        with mock.patch("lambdarest.time.monotonic", return_value=1000.0):
+            lambda_handler = create_lambda_handler(error_log_rate=2)
+            lambda_handler.handle("post")(mock.Mock(side_effect=ZeroDivisionError))
+            with mock.patch("logging.exception") as exception_mock:
+                for _ in range(5):
+                    result = lambda_handler(self.event, self.context)
+                    self.assertEqual(result["statusCode"], 500)
+        self.assertEqual(exception_mock.call_count, 2)
+        self.assertEqual(
+            lambda_handler.metrics["errors"],
+            {"handled": 0, "logged": 2, "suppressed": 3},
+        )
+
+        # custom error handlers see every exception
+        error_handler = mock.Mock()
+        lambda_handler = create_lambda_handler(
+            error_handler=error_handler, error_log_rate=2
+        )
+        lambda_handler.handle("post")(mock.Mock(side_effect=ZeroDivisionError))
+        for _ in range(5):
+            lambda_handler(self.event, self.context)
+        self.assertEqual(error_handler.call_count, 5)
+
+    def test_failing_errorhandler_falls_back_to_the_default_response(self):
+        error_handler = mock.Mock()
+        lambda_handler = create_lambda_handler(error_handler=error_handler)
+
+        @lambda_handler.errorhandler(KeyError)
+        def broken(error):
+            raise RuntimeError("broken error handler")
+
+        lambda_handler.handle("post")(mock.Mock(side_effect=KeyError("id")))
+        with mock.patch("logging.exception") as exception_mock:
+            result = lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 500)
+        self.assertEqual(result["body"], "Internal server error")
+        assert_called_once(exception_mock)
+        (error, _), _ = error_handler.call_args
+        self.assertIsInstance(error, KeyError)
+        self.assertEqual(lambda_handler.metrics["errors"]["handled"], 0)
+
+    def test_access_log_writes_structured_lines(self):
+        logger = mock.Mock()
+        access_log = AccessLog(sample_rates={404: 0, "4xx": 0.5}, logger=logger)
+        lambda_handler = create_lambda_handler(access_log=access_log)
+        lambda_handler.handle("get", path="/items/<int:item_id>")(
+            lambda event, item_id: item_id
+        )
+        self.event["httpMethod"] = "GET"
+        self.event["path"] = self.event["resource"] = "/items/3"
+        self.event["requestContext"] = {"requestId": "abc"}
+
+        with mock.patch("lambdarest.logging.warning") as warning_mock:
+            lambda_handler(self.event, self.context)
+            (line,), _ = logger.info.call_args
+            entry = json.loads(line)
+            self.assertGreaterEqual(entry.pop("latency_ms"), 0)
+            self.assertEqual(
+                entry,
+                {
+                    "method": "GET",
+                    "path": "/items/3",
+                    "route": "/items/<int:item_id>",
+                    "status": 200,
+                    "request_id": "abc",
+                },
+            )
+
+            # 404s are not sampled and no warning is built for them
+            self.event["path"] = self.event["resource"] = "/missing"
+            lambda_handler(self.event, self.context)
+            warning_mock.assert_not_called()
+        self.assertEqual(logger.info.call_count, 1)
+        self.assertEqual(access_log.buffer, [])
+
+        self.event["httpMethod"] = "POST"
+        self.event["path"] = self.event["resource"] = "/items/3"
+        with mock.patch("lambdarest.random.random", side_effect=[0.4, 0.6]):
+            lambda_handler(self.event, self.context)
+            lambda_handler(self.event, self.context)
+        self.assertEqual(logger.info.call_count, 2)
+        self.assertEqual(json.loads(logger.info.call_args[0][0])["status"], 405)
+
+    def test_access_log_buffers_until_flushed(self):
+        logger = mock.Mock()
+        access_log = AccessLog(logger=logger, buffer_size=3)
+        for status in (200, 201):
+            access_log.record(self.event, self.context, "/", status, 1.0)
+        logger.info.assert_not_called()
+        access_log.record(self.event, self.context, "/", 202, 1.0)
+        self.assertEqual(logger.info.call_count, 3)
+
+        logger.isEnabledFor.return_value = False
+        access_log.record(self.event, self.context, "/", 200, 1.0)
+        access_log.flush()
+        self.assertEqual(logger.info.call_count, 3)
+        self.assertEqual(access_log.buffer, [])
+
+    def test_wsgi_adapter_round_trips_proxy_events(self):
+        lambda_handler = create_lambda_handler()
+
+        @lambda_handler.handle("post", path="/echo/<name>", request=True)
+        def echo(request, name):
+            return Response(
+                {
+                    "name": name,
+                    "tag": request.query.getlist("tag"),
+                    "body": request.json["body"],
+                    "cookie": request.cookies.get("session"),
+                },
+                201,
+                multiValueHeaders={"X-Multi": ["a", "b"]},
+            )
+
+        @lambda_handler.handle("get", path="/binary")
+        def binary(event):
+            return Response(
+                base64.b64encode(b"\xff\x00").decode(),
+                headers={"Content-Type": "application/octet-stream"},
+                isBase64Encoded=True,
+            )
+
+        def call(app, path, **kwargs):
+            environ = EnvironBuilder(path, **kwargs).get_environ()
+            return WerkzeugResponse.from_app(app, environ)
+
+        for event_format in ("v1", "v2", "alb"):
+            app = WSGIAdapter(lambda_handler, event_format)
+            response = call(
+                app,
+                "/echo/bob?tag=a&tag=b",
+                method="POST",
+                json={"x": 1},
+                headers={"Cookie": "session=s1"},
+            )
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.headers.getlist("X-Multi"), ["a", "b"])
+            self.assertEqual(
+                json.loads(response.data),
+                {
+                    "name": "bob",
+                    # http apis join repeated query parameters with commas
+                    "tag": ["a,b"] if event_format == "v2" else ["a", "b"],
+                    "body": {"x": 1},
+                    "cookie": "s1",
+                },
+            )
+            self.assertEqual(call(app, "/binary").data, b"\xff\x00")
+            self.assertEqual(call(app, "/missing").status_code, 404)
+
+        with self.assertRaises(ValueError):
+            WSGIAdapter(lambda_handler, "v3")
+
+    def test_asgi_adapter_runs_handler_in_executor(self):
+        lambda_handler = create_lambda_handler()
+        lambda_handler.handle("put", path="/items")(
+            lambda event: (event["json"]["body"], 202)
+        )
+        messages = [
+            {"type": "http.request", "body": b'{"a":', "more_body": True},
+            {"type": "http.request", "body": b" 1}"},
+        ]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "PUT",
+            "path": "/items",
+            "query_string": b"",
+            "headers": [(b"content-type", b"application/json")],
+        }
+        asyncio.run(ASGIAdapter(lambda_handler)(scope, receive, send))
+        self.assertEqual(sent[0]["status"], 202)
+        self.assertIn((b"content-length", b"8"), sent[0]["headers"])
+        self.assertEqual(sent[1], {"type": "http.response.body", "body": b'{"a": 1}'})
+
+    def test_adapters_serve_application_load_balancer_handlers(self):
+        lambda_handler = create_lambda_handler(application_load_balancer=True)
+        lambda_handler.handle("get", path="/created")(lambda event: ("made", 201))
+        self.assertEqual(
+            lambda_handler({"httpMethod": "GET", "path": "/created"}, self.context)[
+                "statusDescription"
+            ],
+            "HTTP Created",
+        )
+
+        app = WSGIAdapter(lambda_handler, "alb")
+        environ = EnvironBuilder("/created").get_environ()
+        start_response = mock.Mock()
+        self.assertEqual(app(environ, start_response), [b"made"])
+        self.assertEqual(start_response.call_args[0][0], "201 Created")
+
+        # a real server rejects anything but a valid status line
+        server = make_server("127.0.0.1", 0, app)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            connection = HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+            connection.request("GET", "/created")
+            response = connection.getresponse()
+            self.assertEqual((response.status, response.read()), (201, b"made"))
+            connection.close()
+        finally:
+            thread.join(5)
+            server.server_close()
+
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b""}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/created", "headers": []}
+        asyncio.run(ASGIAdapter(lambda_handler, "alb")(scope, receive, send))
+        self.assertEqual(sent[0]["status"], 201)
+        self.assertEqual(sent[1]["body"], b"made")
+
+    def test_test_client_builds_events_for_each_format(self):
+        lambda_handler = create_lambda_handler()
+
+        @lambda_handler.handle("post", path="/items/<int:item_id>", request=True)
+        def update_item(request, item_id):
+            return Response(
+                {
+                    "id": item_id,
+                    "body": request.json["body"],
+                    "query": request.query.get("q"),
+                    "token": request.headers.get("X-Token"),
+                },
+                headers={"X-Id": str(item_id)},
+            )
+
+        lambda_handler.handle("put", path="/raw", load_json=False)(
+            lambda event: bytes(event["raw_body"]).hex()
+        )
+
+        for event_format in ("v1", "v2", "alb"):
+            client = TestClient(
+                lambda_handler, event_format, headers={"X-Token": "secret"}
+            )
+            response = client.post("/items/4", json={"a": 1}, query={"q": "x"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["x-id"], "4")
+            self.assertEqual(
+                response.json(),
+                {"id": 4, "body": {"a": 1}, "query": "x", "token": "secret"},
+            )
+            self.assertEqual(client.put("/raw", body=b"\x00\xff").body, "00ff")
+            self.assertEqual(client.get("/items/4").status_code, 405)
+
+        with self.assertRaises(ValueError):
+            TestClient(lambda_handler, "v3")
+
+    def test_http_api_events_are_dispatched_without_being_mutated(self):
+        logger = mock.Mock()
+        lambda_handler = create_lambda_handler(access_log=AccessLog(logger=logger))
+
+        @lambda_handler.handle("get", path="/items/<int:item_id>", request=True)
+        def get_item(request, item_id):
+            return {"method": request.method, "path": request.path, "id": item_id}
+
+        event = TestClient(lambda_handler, "v2").build_event("get", "/items/3")
+        original = copy.deepcopy(event)
+        result = lambda_handler(event, self.context)
+        self.assertEqual(
+            json.loads(result["body"]), {"method": "GET", "path": "/items/3", "id": 3}
+        )
+        self.assertEqual(event, original)
+        (line,), _ = logger.info.call_args
+        entry = json.loads(line)
+        self.assertEqual((entry["method"], entry["path"]), ("GET", "/items/3"))
+
+    def test_test_client_events_share_templates_and_run_in_a_loop(self):
+        handler = mock.Mock(return_value={"statusCode": 204})
+        client = TestClient(handler)
+        first = client.build_event("get", "/a")
+        second = client.build_event("get", "/b", query=[("tag", 1), ("tag", 2)])
+
+        self.assertIs(first["requestContext"], second["requestContext"])
+        self.assertIs(first["headers"], client.template["headers"])
+
+        # clients do not share nested dicts with each other
+        other = TestClient(handler)
+        first["headers"]["X-Leaked"] = "yes"
+        self.assertEqual(other.build_event("get", "/a")["headers"], {})
+        self.assertIsNot(
+            other.template["requestContext"], client.template["requestContext"]
+        )
+        self.assertEqual(second["multiValueQueryStringParameters"], {"tag": ["1", "2"]})
+        self.assertEqual(second["queryStringParameters"], {"tag": "2"})
+
+        results = client.run([first, second], repeat=50)
+        self.assertEqual(results, [{"statusCode": 204}] * 2)
+        self.assertEqual(handler.call_count, 100)
+        self.assertEqual(
+            len(set(id(context) for (_, context), _ in handler.call_args_list)), 1
+        )
+
+        # requests get contexts of their own
+        handler.reset_mock()
+        with mock.patch("lambdarest.wsgi.time.monotonic", return_value=1000.0):
+            client.get("/a")
+        with mock.patch("lambdarest.wsgi.time.monotonic", return_value=1040.0):
+            client.get("/a")
+            contexts = [context for (_, context), _ in handler.call_args_list]
+            self.assertNotEqual(contexts[0].aws_request_id, contexts[1].aws_request_id)
+            self.assertEqual(contexts[1].get_remaining_time_in_millis(), 30000)
+
+        context = mock.Mock()
+        TestClient(handler, context=context).get("/a")
+        handler.assert_called_with(mock.ANY, context)
+
+    def test_multi_value_query_params_are_cast_with_the_schema(self):
+        schema = {
+            "type": "object",
+            "properties": {
+                "query": {
+                    "type": "object",
+                    "properties": {
+                        "ids": {"type": "array", "items": {"type": "integer"}},
+                        "q": {"type": "string"},
+                    },
+                }
+            },
+        }
+        handler = mock.Mock(side_effect=lambda event: event["json"]["query"])
+        self.lambda_handler.handle("get", path="/", schema=schema)(handler)
+        self.event["httpMethod"] = "GET"
+
+        for query, multi_value_query in [
+            ({"ids": "3", "q": "x"}, {"ids": ["1", "2", "3"], "q": ["x"]}),
+            ({"ids": "1,2,3", "q": "x"}, None),
+            ({"ids": "3", "q": "x"}, {"ids": ["1,2,3"], "q": ["x"]}),
+        ]:
+            self.event["queryStringParameters"] = query
+            self.event["multiValueQueryStringParameters"] = multi_value_query
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(json.loads(result["body"]), {"ids": [1, 2, 3], "q": "x"})
+
+        self.event["multiValueQueryStringParameters"] = {"ids": ["1"], "q": ["x", "y"]}
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(result["statusCode"], 400)
+
+    def test_multi_value_headers_without_single_value_headers(self):
+        # load balancers with multi value headers enabled only send these
+        self.event.pop("headers", None)
+        self.event["multiValueHeaders"] = {
+            "Content-Type": ["application/x-www-form-urlencoded"],
+            "X-Tag": ["a", "b"],
+        }
+        self.event["multiValueQueryStringParameters"] = {"page": ["1", "2"]}
+        self.event["body"] = "name=foo&name=bar"
+        self.lambda_handler.handle("post", request=True)(
+            lambda request: {
+                "tags": request.headers.getlist("x-tag"),
+                "page": request.query.getlist("page"),
+                "json": request.json,
+            }
+        )
+        result = self.lambda_handler(self.event, self.context)
+        self.assertEqual(
+            json.loads(result["body"]),
+            {
+                "tags": ["a", "b"],
+                "page": ["1", "2"],
+                "json": {
+                    "body": {"name": ["foo", "bar"]},
+                    "query": {"page": ["1", "2"]},
+                },
+            },
+        )
+
+    def test_coalesce_shares_one_call_between_identical_requests(self):
+        started = threading.Event()
+        release = threading.Event()
+        leader_done = threading.Event()
+        waiting = threading.Semaphore(0)
+
+        class SignallingFuture(Future):
+            def result(self, timeout=None):
+                waiting.release()
+                result = super().result(timeout)
+                # let the leader's after request handlers run first
+                leader_done.wait(5)
+                return result
+
+        def slow(event):
+            started.set()
+            release.wait(5)
+            return {"body": event["body"]}, 201, {"X-Shared": "no"}
+
+        handler = mock.Mock(side_effect=slow)
+        self.lambda_handler.handle(
+            "post",
+            coalesce_key=lambda event: (
+                event["body"],
+                (event["headers"] or {}).get("Cookie"),
+            ),
+        )(handler)
+        after_request_calls = []
+
+        @self.lambda_handler.after_request
+        def number_response(response):
+            after_request_calls.append(response)
+            response.headers.setdefault("X", str(len(after_request_calls)))
+            leader_done.set()
+            return response
+
+        results = []
+
+        def call():
+            results.append(self.lambda_handler(copy.deepcopy(self.event), self.context))
+
+        with mock.patch("lambdarest.Future", SignallingFuture):
+            threads = [threading.Thread(target=call) for _ in range(4)]
+            threads[0].start()
+            self.assertTrue(started.wait(5))
+            for thread in threads[1:]:
+                thread.start()
+            for _ in threads[1:]:
+                self.assertTrue(waiting.acquire(timeout=5))
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        handler.assert_called_once()
+        self.assertEqual([result["statusCode"] for result in results], [201] * 4)
+        # every request gets its own copy of the response
+        self.assertEqual(
+            sorted(result["headers"]["X"] for result in results), ["1", "2", "3", "4"]
+        )
+        self.assertEqual(
+            self.lambda_handler.metrics["coalescing"],
+            {"POST /": {"executed": 1, "coalesced": 3}},
+        )
+
+    def test_coalesce_keys_and_errors(self):
+        calls = []
+
+        def handler(event, name):
+            calls.append(name)
+            if name == "boom":
+                raise ValueError("boom")
+            return name
+
+        self.lambda_handler.handle(
+            "get", path="/<name>", coalesce_key=lambda event, name: name[0]
+        )(handler)
+        self.event["httpMethod"] = "GET"
+        for name in ("abc", "axe", "boom"):
+            self.event["resource"] = "/" + name
+            result = self.lambda_handler(self.event, self.context)
+        # sequential requests are never coalesced, errors are not cached
+        self.assertEqual(calls, ["abc", "axe", "boom"])
+        self.assertEqual(result["statusCode"], 500)
+        self.assertEqual(
+            self.lambda_handler.metrics["coalescing"]["GET /<name>"],
+            {"executed": 3, "coalesced": 0},
+        )
+
+    def test_coalescing_needs_a_key(self):
+        # responses may depend on cookies or other identity headers, so there
+        # is no default key that would be safe to share responses on
+        with self.assertRaises(TypeError):
+            self.lambda_handler.handle("post", coalesce=True)
+        self.lambda_handler.handle("post")(lambda event: "ok")
+        self.lambda_handler(self.event, self.context)
+        self.assertEqual(self.lambda_handler.metrics["coalescing"], {})
+
+    def test_rate_limited_routes_answer_429(self):
+        handler = mock.Mock(return_value="ok")
+        with mock.patch("lambdarest.time.monotonic", return_value=1000.0) as now:
+            self.lambda_handler.handle("post", rate_limit=0.5, burst=2)(handler)
+            self.lambda_handler.after_request(
+                lambda response: Response(
+                    response.body,
+                    response.status_code,
+                    dict(response.headers or {}, X="y"),
+                )
+            )
+            statuses = [
+                self.lambda_handler(self.event, self.context)["statusCode"]
+                for _ in range(3)
+            ]
+            self.assertEqual(statuses, [200, 200, 429])
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(
+                result,
+                {
+                    "body": "Too Many Requests",
+                    "statusCode": 429,
+                    "headers": {"Retry-After": "2", "X": "y"},
+                },
+            )
+
+            now.return_value = 1002.0
+            self.assertEqual(
+                self.lambda_handler(self.event, self.context)["body"], "ok"
+            )
+        self.assertEqual(handler.call_count, 3)
+        self.assertEqual(
+            self.lambda_handler.metrics["limits"],
+            {"POST /": {"admitted": 3, "throttled": 2, "shed": 0, "in_flight": 0}},
+        )
+
+        for rate_limit in (0, -1):
+            with self.assertRaises(ValueError):
+                self.lambda_handler.handle("get", rate_limit=rate_limit)
+
+    def test_max_concurrency_sheds_with_503(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow(event):
+            started.set()
+            release.wait(5)
+            return "done"
+
+        self.lambda_handler.handle("post", max_concurrency=1, retry_after=3)(slow)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(
+                self.lambda_handler(copy.deepcopy(self.event), self.context)
+            )
+        )
+        thread.start()
+        self.assertTrue(started.wait(5))
+        stats = self.lambda_handler.metrics["limits"]["POST /"]
+        self.assertEqual(stats["in_flight"], 1)
+
+        result = self.lambda_handler(copy.deepcopy(self.event), self.context)
+        self.assertEqual(result["statusCode"], 503)
+        self.assertEqual(result["headers"], {"Retry-After": "3"})
+        release.set()
+        thread.join(5)
+        self.assertEqual(results[0]["body"], "done")
+        self.assertEqual(
+            stats, {"admitted": 1, "throttled": 0, "shed": 1, "in_flight": 0}
+        )
+
+        # slots are released when handlers fail too
+        release.clear()
+        self.lambda_handler.handle("get", max_concurrency=1)(
+            mock.Mock(side_effect=ValueError)
+        )
+        self.event["httpMethod"] = "GET"
+        for _ in range(2):
+            result = self.lambda_handler(self.event, self.context)
+            self.assertEqual(result["statusCode"], 500)